@@ -1,13 +1,24 @@
 import chatParser
-from postgresWrapper import PostgresWrapper
+from dataContainers import MessageSnapshot
+from postgresWrapper import PostgresWrapper, AsyncPostgresWrapper
 from functionExecutor import FunctionExecutor
 from cryptoConverter import CryptoConverter
 from broker import OttoBroker
+from commandSync import CommandSync
+from rateLimiter import SlidingWindowLimiter
+from requestLogger import RequestLogger
+from pendingScheduler import PendingResponseScheduler
+from dispatcher import KeyedDispatcher
+from messageSender import MessageSender
+from replyChunker import split_reply
+from tipQueue import TipQueue
+import globalSettings
 
 import discord
 
 import datetime
 import asyncio
+import functools
 import logging
 import traceback
 
@@ -26,19 +37,56 @@ class DiscordWrapper(discord.Client):
         super().__init__(*args, **kwargs)
         self.ping_task = None
         self.token = token
-        self.db = PostgresWrapper(connectionString)
-        self._broker = OttoBroker(webWrapper, self.db, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key)
+        pool_max = globalSettings.config.getint('DEFAULT', 'db_pool_max', fallback=0)
+        self.db = AsyncPostgresWrapper(
+            PostgresWrapper(connectionString,
+                globalSettings.config.getint('DEFAULT', 'db_pool_min', fallback=1),
+                pool_max,
+                globalSettings.config.getint('DEFAULT', 'db_pool_health_check', fallback=30)),
+            self.loop,
+            #never run more queries at once than the pool can hand out connections for
+            pool_max if pool_max > 0 else globalSettings.config.getint('DEFAULT', 'db_workers', fallback=4))
+        self.request_logger = RequestLogger(self.db,
+            globalSettings.config.getint('DEFAULT', 'request_log_batch_size', fallback=50),
+            globalSettings.config.getfloat('DEFAULT', 'request_log_flush_interval', fallback=2))
+        self._broker = OttoBroker(webWrapper, self.db, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key,
+            user_cache_ttl=globalSettings.config.getfloat('DEFAULT', 'broker_user_cache_ttl', fallback=30))
+        self.test_mode_interval = globalSettings.config.getfloat('DEFAULT', 'broker_test_mode_interval', fallback=60)
         self.function_executor = FunctionExecutor(self._broker)
         self.chat_parser = chatParser.ChatParser(prefix, self.db, self.function_executor)
+        self.message_dispatcher = KeyedDispatcher(
+            globalSettings.config.getint('DEFAULT', 'message_workers', fallback=8), 'message')
+        #past this many queued messages, new commands are dropped until the queue drains
+        self.message_queue_limit = globalSettings.config.getint('DEFAULT', 'message_queue_limit', fallback=100)
+        self.message_queue_saturated = False
+        #commands dropped since the queue last filled up
+        self.message_queue_shed = 0
+        self.pending_dispatcher = KeyedDispatcher(
+            globalSettings.config.getint('DEFAULT', 'pending_response_workers', fallback=8), 'pending response')
+        self.pending_scheduler = PendingResponseScheduler(self.db, self.handle_pending_responses)
+        self.pending_scheduler.load()
+        self.command_sync = None
+        if globalSettings.config.get('DEFAULT', 'command_sync', fallback='True') == 'True':
+            self.command_sync = CommandSync(self.chat_parser, self.db, self.loop)
         self.webWrapper = webWrapper
         self.spam_limit = spamLimit
         self.spam_timeout = spamTimeout
+        self.spam_limiter = SlidingWindowLimiter(spamLimit, spamTimeout)
+        #pick up where we left off, so a restart doesn't reset everyone's limit
+        recent = self.db.sync.get_requests_since(datetime.datetime.now() - datetime.timedelta(seconds=spamTimeout), do_log=False)
+        self.spam_limiter.warm((r.requested_by, r.requested) for r in recent)
         self.display_response_id = displayResponseId
         #hardcoding because lazy
         self.status_frequency = 60
         self.crypto = CryptoConverter(self.webWrapper)
         self.ping_retry_max = 10
         self.ping_retry_count = self.ping_retry_max
+        #max number of chars discord allows in a message
+        self.max_message_length = 1500
+        self.sender = MessageSender(self.send_message, self.max_message_length,
+            globalSettings.config.getint('DEFAULT', 'channel_message_burst', fallback=5),
+            globalSettings.config.getfloat('DEFAULT', 'channel_message_period', fallback=5))
+        self.tip_queue = TipQueue(self.db, self._broker, self.reply_to_channel)
 
     async def clear_chat(self, server_id, channel_id):
         for server in self.servers:
@@ -105,28 +153,59 @@ class DiscordWrapper(discord.Client):
             _logger.info("awaiting next frequency update" + str(self.status_frequency))
             await asyncio.sleep(self.status_frequency)
     
+    async def start_test_mode_refresher(self):
+        _logger.info("starting broker test mode refresher")
+        while not self.is_closed:
+            await self._broker.refresh_test_mode()
+            await asyncio.sleep(self.test_mode_interval)
+
+    @property
+    def message_queue_depth(self):
+        #messages waiting on or being handled by the worker pool
+        return len(self.message_dispatcher)
+
     async def on_message(self, message):
         try:
             if message.server and not message.channel.permissions_for(message.server.me).send_messages:
                 return
         except Exception as e:
             _logger.error("Failed to get permissions for bot user. Assuming the bot has permissions")
-        
+
+        if self._broker.is_tip_message(message):
+            #tips are handled off to the side, so a slow broker never holds up chat
+            ensure_future(self.tip_queue.enqueue(message))
+
+        cmd = self.chat_parser.find_command(message.content)
+        if cmd is None:
+            #plain chatter. there's nothing for us to do with it
+            return
+
+        depth = self.message_queue_depth
+        if depth >= self.message_queue_limit:
+            if not self.message_queue_saturated:
+                _logger.warn("message queue saturated (%s waiting). dropping new commands", depth)
+                self.message_queue_saturated = True
+            self.message_queue_shed += 1
+            return
+        if self.message_queue_saturated and depth < self.message_queue_limit // 2:
+            _logger.info("message queue recovered (%s waiting). dropped %s commands", depth, self.message_queue_shed)
+            self.message_queue_saturated = False
+            self.message_queue_shed = 0
+
+        self.message_dispatcher.submit(message.channel.id, functools.partial(self.process_message, message, cmd))
+
+    async def process_message(self, message, cmd=None):
         try:
-            reply_generator = self.chat_parser.get_replies(message, self, self.webWrapper, self.db, self.spam_timeout, self.spam_limit, self.display_response_id)
+            reply_generator = await self.chat_parser.get_replies(message, self, self.webWrapper, self.spam_limiter, self.display_response_id, cmd)
             if reply_generator:
                 async for reply in reply_generator:
                     if not reply:
                         continue
                     await self.handle_reply(message, reply)
-            
-            tip_result = await self._broker.check_for_tips(message)
-            if tip_result:
-                await self.handle_reply(message, tip_result)
 
         except Exception as e:
             _logger.exception(e)
-            await self.send_message(message.channel, 'Ya dun fucked up (Exception: {})'.format(e))
+            self.sender.enqueue(message.channel, 'Ya dun fucked up (Exception: {})'.format(e))
 
     
     # this will probably make sense once I understand ensure_future and start_ping
@@ -142,50 +221,84 @@ class DiscordWrapper(discord.Client):
         if self.ping_task and not self.ping_task.done():
             self.ping_task.cancel()
 
+        try:
+            await self.request_logger.close()
+        except Exception:
+            self.log_exception("Failed to flush buffered requests")
+
+        await self.sender.flush()
+
         try:
             await self.close()
         except Exception:
             self.log_exception("Error when disconnecting")
+
+        await self.db.close()
     
+    async def insert_pending_response(self, request_id, response_id, when, message):
+        #the request row has to exist before anything can point at it
+        await self.request_logger.flush()
+        return await self.pending_scheduler.schedule(request_id, response_id, when, message)
+
+    async def delete_pending_response(self, pending_id):
+        await self.db.delete_pending_response(pending_id)
+        self.pending_scheduler.cancel(pending_id)
+
     async def handle_reply(self, message, reply):
         if not reply:
             _logger.info("received empty string from yield. continuing...")
         else:
-            #max number of chars discord allows in a message
-            max_length = 1500
-            reply_list = []
-            next_reply = reply
-            while len(next_reply) > max_length:
-                newline = next_reply.rfind('\n')
-                if newline == -1:
-                    reply_list.append(next_reply[0:max_length])
-                    next_reply = next_reply[max_length:]
-                else:
-                    reply_list.append(next_reply[0:newline])
-                    next_reply = next_reply[newline+1:]
-            reply_list.append(next_reply)
+            reply_list = split_reply(reply, self.max_message_length)
+            #queued rather than sent here, so the caller doesn't wait on discord
             for r in reply_list:
-                await self.send_message(message.channel, r)
+                self.sender.enqueue(message.channel, r)
     
+    async def reply_to_channel(self, channel_id, reply):
+        channel = self.get_channel(channel_id) or discord.Object(id=channel_id)
+        for r in split_reply(reply, self.max_message_length):
+            self.sender.enqueue(channel, r)
+
     async def check_pending_responses(self):
         _logger.info("Staring pending response checker")
-        while True:
-            #only check every 5 seconds
-            await asyncio.sleep(5)
-            try:
-                responses = self.db.get_ready_pending_responses()
-                for response in responses:
-                    request = self.db.get_request(response.request_id)
-                    _logger.info("handling pending response (%s) for request (%s) for command (%s)", str(response.id), str(request.id), str(request.command_id))
-                    if request.command_id in self.chat_parser.commands:
-                        if response.next_response in self.chat_parser.responses[request.command_id]:
-                            async for reply in self.chat_parser.get_responses(request.command_id, response.next_response, request.id, response.message, self, self.webWrapper, self.display_response_id, 1):
-                                await self.handle_reply(response.message, reply)
-                        else:
-                            _logger.warn("response (%s) for request (%s) no longer exists. ignoring", str(response.next_response), str(request.id))
-                    else:
-                        _logger.warn("command for request (%s) is no longer active. ignoring", str(request.id))
-                    _logger.info("pending response (%s) handled", str(response.id))
-                    self.db.delete_pending_response(response.id)
-            except Exception as e:
-                _logger.error("Ignoring error in check_pending_responses: %s", str(e))
+        await self.pending_scheduler.run()
+
+    async def handle_pending_responses(self, responses):
+        #claim everything that came due in one round trip. anything we don't get back was
+        #deleted or picked up by another instance in the meantime
+        claimed = await self.db.claim_pending_responses([r.id for r in responses], do_log=False)
+        _logger.info("claimed %s of %s due pending responses", len(claimed), len(responses))
+        #hand them to the dispatcher and return right away, so a slow one doesn't hold up the rest.
+        #responses come due in order, and the dispatcher keeps that order within each channel
+        for response, request in sorted(claimed, key=lambda c: (c[0].execute, c[0].id)):
+            self.pending_dispatcher.submit(response.message.channel.id, functools.partial(self.handle_pending_response, response, request))
+
+    def restore_message(self, message):
+        #swap a stored snapshot's ids back for live discord objects where we can find them
+        if not isinstance(message, MessageSnapshot):
+            return message
+        channel_id = message.channel.id
+        message.channel = self.get_channel(channel_id) or discord.Object(id=channel_id)
+        if message.server:
+            server = self.get_server(message.server.id)
+            if server:
+                message.server = server
+                member = server.get_member(message.author.id)
+                if member:
+                    message.author = member
+        return message
+
+    async def handle_pending_response(self, response, request):
+        try:
+            message = self.restore_message(response.message)
+            _logger.info("handling pending response (%s) for request (%s) for command (%s)", str(response.id), str(request.id), str(request.command_id))
+            if request.command_id in self.chat_parser.commands:
+                if response.next_response in self.chat_parser.responses[request.command_id]:
+                    async for reply in self.chat_parser.get_responses(request.command_id, response.next_response, request.id, message, self, self.webWrapper, self.display_response_id, 1):
+                        await self.handle_reply(message, reply)
+                else:
+                    _logger.warn("response (%s) for request (%s) no longer exists. ignoring", str(response.next_response), str(request.id))
+            else:
+                _logger.warn("command for request (%s) is no longer active. ignoring", str(request.id))
+            _logger.info("pending response (%s) handled", str(response.id))
+        except Exception as e:
+            _logger.error("Ignoring error in check_pending_responses: %s", str(e))
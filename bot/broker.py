@@ -1,4 +1,6 @@
-from webWrapper import RestWrapper, SynchronousRestWrapper
+from brokerCache import UserProfileCache
+from webWrapper import RestWrapper, WebWrapper
+import portfolio
 
 import json
 import logging
@@ -9,16 +11,34 @@ from decimal import Decimal, ROUND_HALF_UP, ROUND_HALF_DOWN
 
 _logger = logging.getLogger()
 
+class BrokerAPIError(Exception):
+    # the broker got the request and turned it down, so nothing changed on its end
+    pass
+
 class OttoBroker():
     STATUS_KEY = 'status'
     MESSAGE_KEY = 'message'
 
     STATUS_SUCCESS = 'success'
 
-    def __init__(self, webWrapper, db, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key):
-        self._stock_api = RestWrapper(webWrapper, "https://api.iextrading.com/1.0", {})
-
-        self._broker_api = SynchronousRestWrapper("http://otto.runtimeexception.net/broker", {})
+    # how process_tip went
+    TIP_DONE = 'done'
+    # failed before any money moved, so it's safe to try again
+    TIP_RETRY = 'retry'
+    # lost track of the deposit partway through. it may or may not have happened
+    TIP_UNKNOWN = 'unknown'
+
+    def __init__(self, webWrapper, db, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key, user_cache_ttl=30):
+        self._stock_api = RestWrapper(webWrapper, "https://api.iextrading.com/1.0", {}, 'broker', WebWrapper.PRIORITY_HIGH)
+
+        # every broker endpoint is a GET, including the ones that move money, so never share or cache them
+        self._broker_api = RestWrapper(webWrapper, "http://otto.runtimeexception.net/broker", {}, 'broker', WebWrapper.PRIORITY_HIGH, coalesce=False)
+        self._broker_timeout = 10
+        self._users = UserProfileCache(user_cache_ttl)
+        # None until we've heard from the broker. after that it's kept fresh by refresh_test_mode and by toggles
+        self._test_mode = None
+        # bumped by every toggle, so a /test_mode answer that was already in flight can't undo one
+        self._test_mode_generation = 0
         self._broker_api_key = broker_api_key
         
         self._tip_verifier = tip_verifier
@@ -65,7 +85,7 @@ class OttoBroker():
             unparsed = await response.text()
             data = None
             try:
-                data = json.loads(unparsed)
+                data = await response.json()
             except Exception:
                 raise Exception('Invalid API response: {}'.format(unparsed))
             if data is None:
@@ -114,8 +134,9 @@ class OttoBroker():
         except Exception as e:
             raise Exception('Couldn\'t get stock value: {}'.format(str(e)))
     
-    def _broker_api_wrapper(self, endpoint, params):
-        unparsed = self._broker_api.request(endpoint, params)
+    async def _broker_api_wrapper(self, endpoint, params):
+        response = await self._broker_api.request(endpoint, params, self._broker_timeout)
+        unparsed = await response.text()
         data = None
         try:
             data = json.loads(unparsed)
@@ -127,22 +148,68 @@ class OttoBroker():
         if data[self.STATUS_KEY] == self.STATUS_SUCCESS:
             return data
         else:
-            raise Exception('Broker API trying to access endpoint {}, returned error {}'.format(endpoint, data['message']))
+            raise BrokerAPIError('Broker API trying to access endpoint {}, returned error {}'.format(endpoint, data['message']))
     
-    def _get_test_mode(self):
-        return self._broker_api_wrapper('/test_mode', {})['test_mode']
+    async def _fetch_test_mode(self):
+        generation = self._test_mode_generation
+        active = (await self._broker_api_wrapper('/test_mode', {}))['test_mode']
+        if generation == self._test_mode_generation:
+            self._test_mode = active
+        return self._test_mode
+
+    async def _get_test_mode(self):
+        if self._test_mode is None:
+            return await self._fetch_test_mode()
+        return self._test_mode
+
+    async def refresh_test_mode(self):
+        # called periodically. on failure, keep whatever we knew last
+        try:
+            previous = self._test_mode
+            active = await self._fetch_test_mode()
+            if previous is not None and active != previous:
+                _logger.info('broker test mode changed to {}'.format(active))
+        except Exception as e:
+            _logger.error('Could not refresh broker test mode: {}'.format(str(e)))
         
-    def _get_user(self, user_id):
-        return self._broker_api_wrapper('/user_info',{'userid': user_id, 'shallow': 'false', 'historical': 'true'})['user']
+    async def _get_user(self, user_id, deep=False):
+        # most handlers only need to know who the user is, which any recent copy of the profile can tell us.
+        # deep lookups (holdings, history) always go to the broker since they include live stock values
+        if not deep:
+            user = self._users.get(user_id)
+            if user is not None:
+                return user
+            params = {'userid': user_id, 'shallow': 'true'}
+        else:
+            params = {'userid': user_id, 'shallow': 'false', 'historical': 'true'}
+
+        user = (await self._broker_api_wrapper('/user_info', params))['user']
+        self._users.put(user_id, user)
+        return user
+
+    async def _broker_update(self, user_id, endpoint, params):
+        # for endpoints that change the user. they send back the updated user, which replaces our copy.
+        # if they don't (or fail partway), we can't trust our copy anymore
+        try:
+            data = await self._broker_api_wrapper(endpoint, params)
+        except Exception:
+            self._users.invalidate(user_id)
+            raise
+
+        if isinstance(data.get('user'), dict):
+            self._users.put(user_id, data['user'])
+        else:
+            self._users.invalidate(user_id)
+        return data
     
     async def _handle_buy_long(self, command_args, message_author):
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         if len(command_args) < 4:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         symbol = command_args[2]
         quantity = command_args[3]
         
-        data = self._broker_api_wrapper('/buy_long',
+        data = await self._broker_update(message_author.id, '/buy_long',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -164,13 +231,13 @@ class OttoBroker():
         )
 
     async def _handle_sell_long(self, command_args, message_author):
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         if len(command_args) < 4:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         symbol = command_args[2]
         quantity = command_args[3]
         
-        data = self._broker_api_wrapper('/sell_long',
+        data = await self._broker_update(message_author.id, '/sell_long',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -193,13 +260,13 @@ class OttoBroker():
         )
     
     async def _handle_buy_short(self, command_args, message_author):
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         if len(command_args) < 4:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         symbol = command_args[2]
         quantity = command_args[3]
         
-        data = self._broker_api_wrapper('/buy_short',
+        data = await self._broker_update(message_author.id, '/buy_short',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -221,13 +288,13 @@ class OttoBroker():
         )
 
     async def _handle_sell_short(self, command_args, message_author):
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         if len(command_args) < 4:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         symbol = command_args[2]
         quantity = command_args[3]
         
-        data = self._broker_api_wrapper('/sell_short',
+        data = await self._broker_update(message_author.id, '/sell_short',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -250,13 +317,13 @@ class OttoBroker():
         )
     
     async def _handle_register(self, command_args, message_author):
-        user = self._broker_api_wrapper('/register',
+        user = (await self._broker_update(message_author.id, '/register',
             {
                 'userid': message_author.id,
                 'displayname': message_author.name,
                 'apikey': self._broker_api_key
             }
-        )['user']
+        ))['user']
 
         return ('Welcome, {}. You have a starting balance of {}'.format(user['display_name'], user['balance']), True)
     
@@ -290,7 +357,7 @@ class OttoBroker():
 
     async def _handle_balance(self, command_args, message_author):
         try:
-            user = self._get_user(message_author.id)
+            user = await self._get_user(message_author.id, deep=True)
 
             errors = []
 
@@ -305,17 +372,9 @@ class OttoBroker():
             liabilities_orig_total = Decimal(0)
             liability_lines = []
 
-            for stock in user['holdings']:
-                count = sum([x['count'] for x in user['holdings'][stock]['stocks']])
-                cur_purchase_stock = sum([Decimal(x['purchase_cost']) * x['count'] for x in user['holdings'][stock]['stocks']])
-                full_stock_value = Decimal(user['holdings'][stock]['total_value'])
+            for stock, count, cur_purchase_stock, full_stock_value, pct_gain in portfolio.value_positions(user['holdings'], 'purchase_cost'):
                 assets_orig_total += cur_purchase_stock
-
-                asset_lines.append([
-                    '{} {}'.format(count, stock),
-                    full_stock_value,
-                    (Decimal(100) * (full_stock_value - cur_purchase_stock) / cur_purchase_stock).quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
-                ])
+                asset_lines.append(['{} {}'.format(count, stock), full_stock_value, pct_gain])
 
             if assets_orig_total == 0:
                 asset_lines.append([
@@ -330,17 +389,9 @@ class OttoBroker():
                     (Decimal(100) * (assets_total - assets_orig_total) / assets_orig_total).quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
                 ])
 
-            for stock in user['shorts']:
-                count = sum([x['count'] for x in user['shorts'][stock]['stocks']])
-                cur_sold_stock = sum([Decimal(x['sell_cost']) * x['count'] for x in user['shorts'][stock]['stocks']])
-                full_stock_value = Decimal(user['shorts'][stock]['total_value'])
+            for stock, count, cur_sold_stock, full_stock_value, pct_gain in portfolio.value_positions(user['shorts'], 'sell_cost', short=True):
                 liabilities_orig_total += cur_sold_stock
-
-                liability_lines.append([
-                    '{} {}'.format(count, stock),
-                    full_stock_value,
-                    (Decimal(100) * (1 - (full_stock_value / cur_sold_stock))).quantize(Decimal('.01'), rounding=ROUND_HALF_UP)
-                ])
+                liability_lines.append(['{} {}'.format(count, stock), full_stock_value, pct_gain])
 
             if liabilities_orig_total == 0:
                 liability_lines.append([
@@ -379,12 +430,12 @@ class OttoBroker():
         if len(command_args) < 3:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         
-        if self._get_test_mode():
+        if await self._get_test_mode():
             raise Exception('No withdrawing in test mode')
 
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         amount = command_args[2]
-        data = self._broker_api_wrapper('/withdraw',
+        data = await self._broker_update(message_author.id, '/withdraw',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -409,18 +460,21 @@ class OttoBroker():
                 break
 
         if is_super_user:
-            active = self._broker_api_wrapper('/toggle_test_mode', {'apikey': self._broker_api_key})['test_mode']
+            self._test_mode_generation += 1
+            active = (await self._broker_api_wrapper('/toggle_test_mode', {'apikey': self._broker_api_key}))['test_mode']
+            self._test_mode_generation += 1
+            self._test_mode = active
             return ('Test mode is ' + ('enabled' if active else 'disabled'), True)
         else:
-            return ('Can\'t let you do that, StarFox. Test mode is still ' + ('enabled' if self._get_test_mode() else 'disabled'), False)
+            return ('Can\'t let you do that, StarFox. Test mode is still ' + ('enabled' if await self._get_test_mode() else 'disabled'), False)
 
     async def _handle_watch(self, command_args, message_author):
         if len(command_args) < 3:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         symbol = command_args[2]
-        data = self._broker_api_wrapper('/set_watch',
+        data = await self._broker_update(message_author.id, '/set_watch',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -435,9 +489,9 @@ class OttoBroker():
         if len(command_args) < 3:
             raise Exception('Sorry, you don\'t seem to have enough values in your message for me to parse.')
         
-        user = self._get_user(message_author.id)
+        user = await self._get_user(message_author.id)
         symbol = command_args[2]
-        data = self._broker_api_wrapper('/remove_watch',
+        data = await self._broker_update(message_author.id, '/remove_watch',
             {
                 'userid': user['id'],
                 'apikey': self._broker_api_key,
@@ -472,50 +526,65 @@ class OttoBroker():
         else:
             return ('Did not recognize command: ' + command, False)
 
-    async def check_for_tips(self, message):
-        if message.author.id == self._tip_verifier:
-            # if we have a message from the tip verifying user (mimibot)
-            # then try to parse out whether they're reporting a tip. and if so, was it to ottobot?
+    def is_tip_message(self, message):
+        # cheap enough to run on every message. only the tip verifying user (mimibot) reports tips
+        return message.author.id == self._tip_verifier and message.content.startswith('Tip completed.')
+
+    async def process_tip(self, content, before_deposit=None):
+        # content is a tip message that already passed is_tip_message. before_deposit, if given, is a
+        # coroutine function awaited right before the deposit call; if it raises, nothing is deposited.
+        # returns (reply or None, one of the TIP_ outcomes)
+        stage = 'checking'
+        try:
+            tip_info = content.split('{')[1].strip('}')
+            # this should now be 'sender_id>receiver_id:amount'
+            tip_info = tip_info.split('>')
+            sender = tip_info[0]
+            receiver = tip_info[1].split(':')[0]
+            if receiver != self._broker_id:
+                return (None, self.TIP_DONE)
+
             try:
-                if message.content.startswith('Tip completed.'):
-                    tip_info = message.content.split('{')[1].strip('}')
-                    # this should now be 'sender_id>receiver_id:amount'
-                    tip_info = tip_info.split('>')
-                    sender = tip_info[0]
-                    receiver = tip_info[1].split(':')[0]
-                    if receiver == self._broker_id:
-                        try:
-                            user = self._get_user(sender)
-                        except Exception as e:
-                            return 'Ottobot thanks you for your generousity, unregistered user'
-                        
-                        amount = Decimal(tip_info[1].split(':')[1])
-                        amount = self._exchange_rate * amount
-                        amount = Decimal(amount.quantize(Decimal('.01'), rounding=ROUND_HALF_DOWN))
-                        
-                        # just an arbitrary way to force money into the test account. 
-                        if self._get_test_mode():
-                            amount = 15000
-                        
-                        if amount > 0:
-                            data = self._broker_api_wrapper('/deposit',
-                                {
-                                    'userid': sender,
-                                    'apikey': self._broker_api_key,
-                                    'amount': amount,
-                                    'reason': 'Withdrawal to Momocoins'
-                                }
-                            )
-
-                            user = data['user']
-                            return 'Ottobot winks at you, {}, and walks away whistling. Your pockets feel heavier. (New balance: {})'.format(
-                                user['display_name'],
-                                user['balance']
-                            )
-                        else:
-                            return 'That tip rounded to 0 cents. You get nothing, good day sir!'
+                user = await self._get_user(sender)
+            except BrokerAPIError as e:
+                return ('Ottobot thanks you for your generousity, unregistered user', self.TIP_DONE)
+            
+            amount = Decimal(tip_info[1].split(':')[1])
+            amount = self._exchange_rate * amount
+            amount = Decimal(amount.quantize(Decimal('.01'), rounding=ROUND_HALF_DOWN))
+            
+            # just an arbitrary way to force money into the test account. 
+            if await self._get_test_mode():
+                amount = 15000
+            
+            if amount > 0:
+                if before_deposit is not None:
+                    await before_deposit()
+                stage = 'depositing'
+                data = await self._broker_update(sender, '/deposit',
+                    {
+                        'userid': sender,
+                        'apikey': self._broker_api_key,
+                        'amount': amount,
+                        'reason': 'Withdrawal to Momocoins'
+                    }
+                )
+                stage = 'deposited'
+
+                user = data['user']
+                return ('Ottobot winks at you, {}, and walks away whistling. Your pockets feel heavier. (New balance: {})'.format(
+                    user['display_name'],
+                    user['balance']
+                ), self.TIP_DONE)
+            else:
+                return ('That tip rounded to 0 cents. You get nothing, good day sir!', self.TIP_DONE)
 
-            except Exception as e:
-                _logger.error('Failed to process tip:({})'.format(message.content))
-                _logger.exception(e)
-                return 'Failed to process tip({}) Go yell at :otto:'.format(e)
\ No newline at end of file
+        except Exception as e:
+            _logger.error('Failed to process tip:({}) while {}'.format(content, stage))
+            _logger.exception(e)
+            if stage == 'deposited':
+                return ('Ottobot took your tip, but got confused about your new balance. Go yell at :otto:', self.TIP_DONE)
+            elif stage == 'depositing' and not isinstance(e, BrokerAPIError):
+                # timed out, connection dropped, garbage back... the broker may well have done it anyway
+                return ('Ottobot lost track of your tip partway through. Someone will check on it. Go yell at :otto:', self.TIP_UNKNOWN)
+            return ('Failed to process tip({}) Go yell at :otto:'.format(e), self.TIP_RETRY)
@@ -0,0 +1,46 @@
+import collections
+import logging
+import time
+
+_logger = logging.getLogger()
+
+#short lived copies of broker user profiles, keyed on the discord id they were looked up with.
+#handlers mostly just need to know who someone is, so any cached profile will do for that.
+#endpoints that change a user hand back the new profile, and that replaces whatever was here
+class UserProfileCache():
+    def __init__(self, ttl=30, maxUsers=1000):
+        self.ttl = ttl
+        self.max_users = maxUsers
+        #user id -> (expires, profile), oldest use first
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, profile, now=None):
+        if self.ttl <= 0:
+            return
+        if now is None:
+            now = time.monotonic()
+        self._entries[user_id] = (now + self.ttl, profile)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
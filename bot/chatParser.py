@@ -1,5 +1,6 @@
 import globalSettings
-from dataContainers import Command
+from dataContainers import Command, Response
+from commandMatcher import CommandIndex
 
 import datetime
 import logging
@@ -16,62 +17,192 @@ class ChatParser():
             self.command_types = None
             self.commands = None
             self.responses = None
+            #ordered copies of each command's linked list of responses, so positional lookups are O(1)
+            self.response_chains = None
+            self._chain_positions = None
+            #response id -> Response, across every command
+            self.responses_by_id = None
+            self.command_index = None
+            #edits await the database, so serialize them to keep the in-memory chains consistent
+            self._edit_lock = asyncio.Lock()
             self.load_from_database()
 
+    #this runs before the event loop starts, so it's fine for it to block
     def load_from_database(self):
         _logger.info("dumping everything and loading from the database")
+        self._build(self.db.sync.get_command_types(do_log=False),
+            self.db.sync.get_active_commands(do_log=False),
+            #pull every response in a single streamed query instead of one query per command
+            self.db.sync.stream_active_responses(do_log=False))
+        _logger.info("finished loading")
+
+    #same as load_from_database, but safe to call once the bot is running
+    async def reload_from_database(self):
+        _logger.info("reloading everything from the database")
+        #read under the lock too, so an edit made while we're reading isn't overwritten by our older copy
+        async with self._edit_lock:
+            command_types = await self.db.get_command_types(do_log=False)
+            commands = await self.db.get_active_commands(do_log=False)
+            responses = await self.db.get_active_responses(do_log=False)
+            self._build(command_types, commands, responses)
+        _logger.info("finished reloading")
+
+    def _build(self, command_types, commands, responses):
         self.command_types = {}
         self.commands = {}
         self.responses = {}
+        self.response_chains = {}
+        self._chain_positions = {}
+        self.responses_by_id = {}
+        self.command_index = CommandIndex()
         
-        for ct in self.db.get_command_types(do_log=False):
+        for ct in command_types:
             self.command_types[ct.id] = ct
         
-        for cmd in self.db.get_active_commands(do_log=False):
+        for cmd in commands:
             self.commands[cmd.id] = cmd
-            self.load_responses_from_database(cmd.id)
-        _logger.info("finished loading")
-    
+            self.responses[cmd.id] = {}
+            self._index_command(cmd)
+
+        for resp in responses:
+            if resp.command_id not in self.responses:
+                continue
+            self.responses[resp.command_id][resp.id] = resp
+            self.responses_by_id[resp.id] = resp
+
+        for cmd_id in self.commands:
+            self._rebuild_chain(cmd_id)
+
+    async def sync_commands(self, command_ids):
+        #apply changes made by somebody else (another bot process, or by hand) to just the commands that changed
+        command_ids = set(command_ids)
+        if not command_ids:
+            return
+        _logger.info("syncing commands from the database: %s", sorted(command_ids))
+        #read under the lock, so a local add_command/delete_response can't land between the read and the apply
+        async with self._edit_lock:
+            changed = {cmd.id: cmd for cmd in await self.db.get_commands(command_ids, do_log=False)}
+            responses = {cmd_id: [] for cmd_id in command_ids}
+            for resp in await self.db.get_responses_for_commands(command_ids, do_log=False):
+                responses[resp.command_id].append(resp)
+
+            for cmd_id in command_ids:
+                cmd = changed.get(cmd_id)
+                if cmd is None or not cmd.active:
+                    if cmd_id in self.commands:
+                        self._forget_command(cmd_id)
+                    continue
+                existing = self.commands.get(cmd_id)
+                if existing is None:
+                    self.commands[cmd_id] = cmd
+                    self._index_command(cmd)
+                elif (existing.text, existing.case_sensitive, existing.command_type_id) != (cmd.text, cmd.case_sensitive, cmd.command_type_id):
+                    #keep the same object around, since callers may be holding on to it
+                    existing.text = cmd.text
+                    existing.removable = cmd.removable
+                    existing.case_sensitive = cmd.case_sensitive
+                    existing.command_type_id = cmd.command_type_id
+                    self._index_command(existing)
+                else:
+                    existing.removable = cmd.removable
+                self._set_responses(cmd_id, responses[cmd_id])
+
+    def _forget_command(self, command_id):
+        self.command_index.remove(command_id)
+        for r in self.responses.get(command_id, {}):
+            self.responses_by_id.pop(r, None)
+        self.commands.pop(command_id, None)
+        self.responses.pop(command_id, None)
+        self._drop_chain(command_id)
+
     def load_responses_from_database(self, command_id):
+        self._set_responses(command_id, self.db.sync.get_responses(command_id, do_log=False))
+
+    def _set_responses(self, command_id, responses):
+        for r in self.responses.get(command_id, {}):
+            self.responses_by_id.pop(r, None)
         self.responses[command_id] = {}
-        for resp in self.db.get_responses(command_id, do_log=False):
+        for resp in responses:
             self.responses[command_id][resp.id] = resp
+            self.responses_by_id[resp.id] = resp
+        self._rebuild_chain(command_id)
+
+    def _rebuild_chain(self, command_id):
+        #walk the linked list once and remember the order
+        responses = self.responses[command_id]
+        chain = []
+        first = None
+        for r in responses:
+            if responses[r].previous is None:
+                first = responses[r]
+                break
+        seen = set()
+        resp = first
+        while resp is not None and resp.id not in seen:
+            seen.add(resp.id)
+            chain.append(resp)
+            resp = responses.get(resp.next) if resp.next is not None else None
+        if len(chain) != len(responses):
+            _logger.warn("response chain for command (%s) is broken. %s of %s responses are reachable", str(command_id), len(chain), len(responses))
+        self.response_chains[command_id] = chain
+        self._chain_positions[command_id] = {r.id: i for i, r in enumerate(chain)}
+
+    def _remove_from_chain(self, command_id, response_id):
+        positions = self._chain_positions[command_id]
+        position = positions.pop(response_id, None)
+        if position is None:
+            return
+        chain = self.response_chains[command_id]
+        del chain[position]
+        for i in range(position, len(chain)):
+            positions[chain[i].id] = i
+
+    def _drop_chain(self, command_id):
+        self.response_chains.pop(command_id, None)
+        self._chain_positions.pop(command_id, None)
 
     def get_first_response(self, command_id):
-        for r in self.responses[command_id]:
-            if self.responses[command_id][r].previous == None:
-                return self.responses[command_id][r]
+        chain = self.response_chains.get(command_id)
+        if chain:
+            return chain[0]
     
     def get_response(self, command_id, i):
         _logger.info("trying to get response " + str(i) + " from command " + str(command_id))
-        cur = 0
-        resp = self.get_first_response(command_id)
-        while resp.next is not None and cur < i:
-            cur += 1
-            resp = self.responses[command_id][resp.next]
-        if cur != i:
-            resp = None
-        return resp
+        chain = self.response_chains[command_id]
+        if 0 <= i < len(chain):
+            return chain[i]
+        return None
 
     def get_response_by_id(self, id):
-        for i in self.responses:
-            for j in self.responses[i]:
-                if self.responses[i][j].id == id:
-                    return self.responses[i][j]
+        return self.responses_by_id.get(id)
 
     def get_last_response(self, command_id):
-        for r in self.responses[command_id]:
-            if self.responses[command_id][r].next == None:
-                return self.responses[command_id][r]
+        chain = self.response_chains[command_id]
+        if chain:
+            return chain[-1]
+
+    def _index_command(self, cmd):
+        self.command_index.add(cmd, self.command_types[cmd.command_type_id].name)
+
+    def find_command(self, text):
+        #same answer as the first command in self.commands that is_match accepts, without the linear scan
+        cmd_id = self.command_index.match(text)
+        if cmd_id is None:
+            return None
+        return self.commands[cmd_id]
 
     def get_command_type_id(self, name):
         for cmd_type in self.command_types:
             if self.command_types[cmd_type].name == name:
                 return self.command_types[cmd_type].id
 
-    def add_command(self, cmd, response):
+    async def add_command(self, cmd, response):
         if not isinstance(cmd, Command):
             raise TypeError("cmd must be a Command object")
+        async with self._edit_lock:
+            await self._add_command(cmd, response)
+
+    async def _add_command(self, cmd, response):
         if not cmd.text.startswith(self.prefix):
             cmd.text = self.prefix + cmd.text
         _logger.info("starting to create cmd: " + cmd.text)
@@ -84,33 +215,49 @@ class ChatParser():
                 cmd = self.commands[c]
         
         if insert:
-            cmd.id = self.db.insert_command(cmd.text, cmd.removable, cmd.case_sensitive, cmd.command_type_id)
+            cmd.id = await self.db.insert_command(cmd.text, cmd.removable, cmd.case_sensitive, cmd.command_type_id)
             self.commands[cmd.id] = cmd
             self.responses[cmd.id] = {}
+            self.response_chains[cmd.id] = []
+            self._chain_positions[cmd.id] = {}
+            self._index_command(cmd)
 
         prev = self.get_last_response(cmd.id)
+        prev_id = prev.id if prev else None
+        new_id = await self.db.insert_response(response.text, response.function, prev_id, cmd.id)
+
+        #mirror what insert_response did to the linked list, rather than reloading the whole command
+        new_response = Response([new_id, response.text, response.function, None, prev_id, cmd.id])
         if prev:
-            prev = prev.id
-        self.db.insert_response(response.text, response.function, prev, cmd.id)
-        self.load_responses_from_database(cmd.id)
+            prev.next = new_id
+        self.responses[cmd.id][new_id] = new_response
+        self.responses_by_id[new_id] = new_response
+        self._chain_positions[cmd.id][new_id] = len(self.response_chains[cmd.id])
+        self.response_chains[cmd.id].append(new_response)
     
-    def delete_response(self, response):
-        self.db.delete_response(response.id, response.next, response.previous)
+    async def delete_response(self, response):
+        async with self._edit_lock:
+            await self._delete_response(response)
+
+    async def _delete_response(self, response):
+        await self.db.delete_response(response.id, response.next, response.previous)
         
-        #reload from the database, since the db function takes care of logic for use
-        self.responses[response.command_id] = {}
-        for resp in self.db.get_responses(response.command_id):
-            self.responses[response.command_id][resp.id] = resp
+        #mirror what the db function did to the linked list, rather than reloading the whole command
+        responses = self.responses[response.command_id]
+        response = responses.get(response.id, response)
+        if response.previous in responses:
+            responses[response.previous].next = response.next
+        if response.next in responses:
+            responses[response.next].previous = response.previous
+        responses.pop(response.id, None)
+        self.responses_by_id.pop(response.id, None)
+        self._remove_from_chain(response.command_id, response.id)
         
         #if we now have an empty list of responses, then deactivate the command
         #make sure to delete the command and corresponding responses!
         if len(self.responses[response.command_id]) == 0:
-            self.db.deactivate_command(response.command_id)
-            _logger.info("test1")
-            del self.commands[response.command_id]
-            _logger.info("test2")
-            del self.responses[response.command_id]
-            _logger.info("test3")
+            await self.db.deactivate_command(response.command_id)
+            self._forget_command(response.command_id)
 
     def is_match(self, command, text):
         to_match = command.text
@@ -126,32 +273,37 @@ class ChatParser():
         else:
             _logger.warn("Unknown command type: " + self.command_types[command.command_type_id].name)
 
-    def get_replies(self, message, bot, web, db, spam_timeout, spam_limit, display_response_id):
+    async def get_replies(self, message, bot, web, spam_limiter, display_response_id, cmd=None):
         # this yields strings until it has completed its reply
-        for i in self.commands:
-            cmd = self.commands[i]
-            if self.is_match(cmd, message.content):
-                
-                recent_requests = db.get_recent_requests(message.author.name, datetime.datetime.now() - datetime.timedelta(seconds=spam_timeout))
-                if len(recent_requests) >= spam_limit:
-                    _logger.info("spam limit hit for user " + message.author.name)
-                    return self.dumb_wrapper("Cool your jets, " + message.author.mention)
-                _logger.info("Matched %s to command %s", message.content, cmd.text)
-                request_id = self.db.insert_request(message.author.name, cmd.id)
-                response = self.get_first_response(cmd.id)
-                return self.get_responses(cmd.id, response.id, request_id, message, bot, web, display_response_id)
+        #cmd is what find_command already matched, if the caller has it. it may have been removed while queued
+        if cmd is None or self.commands.get(cmd.id) is not cmd:
+            cmd = self.find_command(message.content)
+        if cmd is None:
+            return None
+        response = self.get_first_response(cmd.id)
+        if response is None:
+            #a command with no responses (e.g. caught mid edit) has nothing to say
+            _logger.warn("command (%s) has no responses. ignoring", str(cmd.id))
+            return None
+
+        if not spam_limiter.allow(message.author.name):
+            _logger.info("spam limit hit for user " + message.author.name)
+            return self.dumb_wrapper("Cool your jets, " + message.author.mention)
+        _logger.info("Matched %s to command %s", message.content, cmd.text)
+        request_id = await bot.request_logger.log(message.author.name, cmd.id)
+        return self.get_responses(cmd.id, response.id, request_id, message, bot, web, display_response_id)
 
     async def dumb_wrapper(self, message):
         yield message
 
     #helper function to encapsulate response logic (for use with pending responses)
     async def get_responses(self, command_id, response_id, request_id, message, bot, web, display_response_id, max_number_of_responses=-1):
-        response = self.responses[command_id][response_id]
-        response_count = 0
-        while response:
-            response_count += 1
-            if max_number_of_responses != -1 and response_count > max_number_of_responses:
-                break
+        position = self._chain_positions[command_id][response_id]
+        #iterate over a snapshot, since functions further down the chain are allowed to edit it
+        chain = self.response_chains[command_id][position:]
+        if max_number_of_responses != -1:
+            chain = chain[:max_number_of_responses]
+        for response in chain:
             prefix = ""
             if display_response_id:
                 prefix = "(" + str(response.id) + ") "
@@ -164,7 +316,3 @@ class ChatParser():
                     break
             else:
                 _logger.warn("empty response: " + str(response.id))
-            if response.next:
-                response = self.responses[command_id][response.next]
-            else:
-                break
@@ -0,0 +1,209 @@
+import logging
+
+_logger = logging.getLogger()
+
+#sentinel rank for "nothing matched". every real rank is smaller than this
+_NO_MATCH = float('inf')
+
+
+class _TrieNode():
+    __slots__ = ('children', 'ids')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = set()
+
+
+#prefix trie for STARTS_WITH commands. walking the message once finds every command that prefixes it
+class _PrefixTrie():
+    def __init__(self):
+        self.root = _TrieNode()
+
+    def add(self, pattern, command_id):
+        node = self.root
+        for ch in pattern:
+            child = node.children.get(ch)
+            if child is None:
+                child = _TrieNode()
+                node.children[ch] = child
+            node = child
+        node.ids.add(command_id)
+
+    def remove(self, pattern, command_id):
+        path = [self.root]
+        for ch in pattern:
+            node = path[-1].children.get(ch)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].ids.discard(command_id)
+        #prune the branch if nothing hangs off of it anymore
+        for i in range(len(pattern), 0, -1):
+            node = path[i]
+            if node.ids or node.children:
+                break
+            del path[i - 1].children[pattern[i - 1]]
+
+    def best_match(self, text, ranks):
+        node = self.root
+        best = min((ranks[i] for i in node.ids), default=_NO_MATCH)
+        for ch in text:
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.ids:
+                best = min(best, min(ranks[i] for i in node.ids))
+        return best
+
+
+#aho-corasick automaton for CONTAINS commands. a single pass over the message finds every command
+#contained in it. the automaton is rebuilt lazily the next time it's searched after an edit
+class _AhoCorasick():
+    def __init__(self):
+        self.patterns = {}
+        self._dirty = True
+        self._goto = None
+        self._fail = None
+        self._best = None
+
+    def add(self, pattern, command_id):
+        self.patterns.setdefault(pattern, set()).add(command_id)
+        self._dirty = True
+
+    def remove(self, pattern, command_id):
+        ids = self.patterns.get(pattern)
+        if ids is None:
+            return
+        ids.discard(command_id)
+        if not ids:
+            del self.patterns[pattern]
+        self._dirty = True
+
+    def _build(self, ranks):
+        goto = [{}]
+        best = [_NO_MATCH]
+        for pattern, ids in self.patterns.items():
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    best.append(_NO_MATCH)
+                state = nxt
+            best[state] = min(best[state], min(ranks[i] for i in ids))
+
+        #breadth first, so a state's failure link is always finished before the state itself
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                #fold the outputs of the failure chain in, so searching never has to walk it
+                best[nxt] = min(best[nxt], best[fail[nxt]])
+
+        self._goto = goto
+        self._fail = fail
+        self._best = best
+        self._dirty = False
+
+    def best_match(self, text, ranks):
+        if not self.patterns:
+            return _NO_MATCH
+        if self._dirty:
+            self._build(ranks)
+        goto = self._goto
+        fail = self._fail
+        best_by_state = self._best
+        state = 0
+        best = best_by_state[0]
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best_by_state[state] < best:
+                best = best_by_state[state]
+        return best
+
+
+#index over the active commands that answers "which command would the linear is_match loop pick first?"
+#commands are ranked in the order they were added, which mirrors the iteration order of ChatParser.commands
+class CommandIndex():
+    STARTS_WITH = 'STARTS_WITH'
+    CONTAINS = 'CONTAINS'
+    EQUALS = 'EQUALS'
+
+    def __init__(self):
+        self._ranks = {}
+        self._by_rank = {}
+        self._entries = {}
+        self._next_rank = 0
+        #one structure per case sensitivity. case insensitive commands are stored upper-cased
+        self._equals = {True: {}, False: {}}
+        self._starts_with = {True: _PrefixTrie(), False: _PrefixTrie()}
+        self._contains = {True: _AhoCorasick(), False: _AhoCorasick()}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, command, type_name):
+        if command.id in self._entries:
+            self.remove(command.id)
+        if type_name not in (self.STARTS_WITH, self.CONTAINS, self.EQUALS):
+            _logger.warn("Unknown command type: " + str(type_name))
+            return
+
+        case_sensitive = bool(command.case_sensitive)
+        pattern = command.text if case_sensitive else command.text.upper()
+        rank = self._next_rank
+        self._next_rank += 1
+        self._ranks[command.id] = rank
+        self._by_rank[rank] = command.id
+        self._entries[command.id] = (type_name, case_sensitive, pattern)
+
+        if type_name == self.EQUALS:
+            self._equals[case_sensitive].setdefault(pattern, set()).add(command.id)
+        elif type_name == self.STARTS_WITH:
+            self._starts_with[case_sensitive].add(pattern, command.id)
+        else:
+            self._contains[case_sensitive].add(pattern, command.id)
+
+    def remove(self, command_id):
+        entry = self._entries.pop(command_id, None)
+        if entry is None:
+            return
+        type_name, case_sensitive, pattern = entry
+        del self._by_rank[self._ranks.pop(command_id)]
+
+        if type_name == self.EQUALS:
+            ids = self._equals[case_sensitive][pattern]
+            ids.discard(command_id)
+            if not ids:
+                del self._equals[case_sensitive][pattern]
+        elif type_name == self.STARTS_WITH:
+            self._starts_with[case_sensitive].remove(pattern, command_id)
+        else:
+            self._contains[case_sensitive].remove(pattern, command_id)
+
+    def match(self, text):
+        #returns the id of the first matching command, or None
+        ranks = self._ranks
+        folded = text.upper()
+        best = _NO_MATCH
+        for case_sensitive, candidate in ((True, text), (False, folded)):
+            ids = self._equals[case_sensitive].get(candidate)
+            if ids:
+                best = min(best, min(ranks[i] for i in ids))
+            best = min(best, self._starts_with[case_sensitive].best_match(candidate, ranks))
+            best = min(best, self._contains[case_sensitive].best_match(candidate, ranks))
+        if best == _NO_MATCH:
+            return None
+        return self._by_rank[best]
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+_logger = logging.getLogger()
+
+#keeps a ChatParser in step with the database without full reloads.
+#triggers on ottobot.commands and ottobot.responses NOTIFY the id of every command they touch
+#(see createDB.sql/upgradeDB.sql), and we re-read only those commands
+class CommandSync():
+    CHANNEL = 'ottobot_commands'
+
+    def __init__(self, parser, db, loop, debounce=0.5, retryDelay=10):
+        self.parser = parser
+        self.db = db
+        self.loop = loop
+        #edits touch several rows one statement at a time, so give them a moment to settle
+        self.debounce = debounce
+        self.retry_delay = retryDelay
+
+    async def run(self):
+        _logger.info("Starting command sync")
+        connected_before = False
+        while True:
+            connection = None
+            try:
+                connection = await self.db.open_listener(self.CHANNEL)
+                if connected_before:
+                    #anything that changed while we were disconnected never got to us
+                    await self.parser.reload_from_database()
+                connected_before = True
+                await self._listen(connection)
+            except asyncio.CancelledError:
+                _logger.info("Stopping command sync")
+                return
+            except Exception as e:
+                _logger.error("command sync lost its database connection: %s", str(e))
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            await asyncio.sleep(self.retry_delay)
+
+    async def _listen(self, connection):
+        changes = asyncio.Queue()
+
+        def on_readable():
+            try:
+                connection.poll()
+            except Exception as e:
+                changes.put_nowait(e)
+                return
+            while connection.notifies:
+                changes.put_nowait(connection.notifies.pop(0).payload)
+
+        self.loop.add_reader(connection.fileno(), on_readable)
+        try:
+            while True:
+                changed = set()
+                item = await changes.get()
+                await asyncio.sleep(self.debounce)
+                while True:
+                    if isinstance(item, Exception):
+                        raise item
+                    try:
+                        changed.add(int(item))
+                    except ValueError:
+                        _logger.warn("ignoring unexpected command sync payload: %s", item)
+                    if changes.empty():
+                        break
+                    item = changes.get_nowait()
+                await self.parser.sync_commands(changed)
+        finally:
+            self.loop.remove_reader(connection.fileno())
@@ -45,4 +45,42 @@ CREATE TABLE ottobot.pendingresponses(
     FOREIGN KEY(requestid) REFERENCES ottobot.requests(id),
     FOREIGN KEY(nextresponse) REFERENCES ottobot.responses(id)
 );
+CREATE TABLE ottobot.tips(
+    messageid varchar(64) NOT NULL,
+    channelid varchar(64) NOT NULL,
+    content text NOT NULL,
+    status varchar(16) NOT NULL,
+    attempts int NOT NULL DEFAULT 0,
+    received timestamp NOT NULL,
+    nextattempt timestamp NOT NULL DEFAULT now(),
+    claimed timestamp,
+    processed timestamp,
+    PRIMARY KEY(messageid)
+);
+CREATE INDEX tips_queued ON ottobot.tips(received) WHERE status = 'queued';
 INSERT INTO ottobot.commandtypes (name) values ('STARTS_WITH'), ('CONTAINS'), ('EQUALS');
+CREATE OR REPLACE FUNCTION ottobot.notify_command_change() RETURNS trigger AS $$
+DECLARE
+    changed_command int;
+BEGIN
+    IF TG_TABLE_NAME = 'commands' THEN
+        IF TG_OP = 'DELETE' THEN
+            changed_command := OLD.id;
+        ELSE
+            changed_command := NEW.id;
+        END IF;
+    ELSE
+        IF TG_OP = 'DELETE' THEN
+            changed_command := OLD.commandid;
+        ELSE
+            changed_command := NEW.commandid;
+        END IF;
+    END IF;
+    PERFORM pg_notify('ottobot_commands', changed_command::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER commands_changed AFTER INSERT OR UPDATE OR DELETE ON ottobot.commands
+    FOR EACH ROW EXECUTE PROCEDURE ottobot.notify_command_change();
+CREATE TRIGGER responses_changed AFTER INSERT OR UPDATE OR DELETE ON ottobot.responses
+    FOR EACH ROW EXECUTE PROCEDURE ottobot.notify_command_change();
@@ -1,6 +1,5 @@
 from webWrapper import RestWrapper
 
-import json
 import logging
 
 _logger = logging.getLogger()
@@ -8,12 +7,13 @@ _logger = logging.getLogger()
 class CryptoConverter():
     def __init__(self, webWrapper):
         self.rest = RestWrapper(webWrapper,
-            "https://api.coinmarketcap.com")
+            "https://api.coinmarketcap.com", caller='crypto',
+            cacheTTLs=[('/v2/listings', 3600), ('/v2/ticker/*', 30), ('/v2/global', 60)])
 
     async def get_symbols(self):
         result = {}
         response = await self.rest.request('/v2/listings', {})
-        data = json.loads(await response.text())
+        data = await response.json()
         if data:
             for coin in data['data']:
                 result[coin['symbol']] = str(coin['id'])
@@ -24,7 +24,7 @@ class CryptoConverter():
     async def convert(self, base_type, target_type):
         result = 0
         response = await self.rest.request("/v2/ticker/" + base_type, {'convert': target_type.upper()})
-        data = json.loads(await response.text())
+        data = await response.json()
         try:
             result = float(data['data']['quotes'][target_type]['price'])
         except Exception as e:
@@ -36,14 +36,14 @@ class CryptoConverter():
         
         if coin is None:
             response = await self.rest.request("/v2/global", {})
-            data = json.loads(await response.text())
+            data = await response.json()
             try:
                 result = data['data']['quotes']['USD']['total_market_cap']
             except Exception as e:
                 _logger.error("Exception trying to get total market cap: " + str(e))
         else:
             response = await self.rest.request("/v2/ticker/" + coin, {})
-            data = json.loads(await response.text())
+            data = await response.json()
             try:
                 result = float(data['data']['quotes']['USD']['market_cap'])
             except Exception as e:
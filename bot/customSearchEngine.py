@@ -1,6 +1,5 @@
-from webWrapper import RestWrapper
+from webWrapper import RestWrapper, WebWrapper
 
-import json
 import logging
 
 _logger = logging.getLogger()
@@ -23,19 +22,20 @@ class CustomSearchEngine():
     def __init__(self, webWrapper, cx, apiKey):
         self.rest = RestWrapper(webWrapper, 
                 "https://www.googleapis.com/customsearch/v1",
-                {'cx': cx, 'key': apiKey})
+                {'cx': cx, 'key': apiKey}, 'cse', WebWrapper.PRIORITY_LOW,
+                cacheTTLs=[('*', 3600)])
 
     async def search(self, query):
         response = await self.rest.request("", {'q': query, 'num': '1'})
         result = SearchResponse(response.status, [])
 
         if response.status == 200:
-            data = json.loads(await response.text())
+            data = await response.json()
             if int(data['searchInformation']['totalResults']) > 0:
                 for i in data['items']:
                     result.items.append(ResponseSummary(i['title'], i['link']))
         else:
-            errors = json.loads(await response.text())
+            errors = await response.json()
             _logger.error("Issue with cse request: " + errors['error']['message'])
             result.error_message = errors['error']['message']
             
@@ -1,3 +1,4 @@
+import json
 import pickle
 
 class CommandType():
@@ -23,7 +24,68 @@ class PendingResponse():
         self.next_response = raw[2]
         self.stored = raw[3]
         self.execute = raw[4]
-        self.message = pickle.loads(raw[5])
+        #decoded the first time somebody actually needs it
+        self._raw_message = bytes(raw[5]) if raw[5] is not None else None
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None and self._raw_message is not None:
+            self._message = MessageSnapshot.decode(self._raw_message)
+        return self._message
+
+    @property
+    def has_legacy_message(self):
+        return self._raw_message is not None and not MessageSnapshot.is_snapshot(self._raw_message)
+
+
+class SnapshotEntity():
+    def __init__(self, id, name=None, mention=None):
+        self.id = id
+        self.name = name
+        self.mention = mention
+
+
+#the parts of a discord message that replaying a pending response needs, and nothing else.
+#stored as a small json blob instead of a pickle of the whole message (and client) object graph
+class MessageSnapshot():
+    def __init__(self, channel_id, server_id, author_id, author_name, author_mention, content):
+        self.channel = SnapshotEntity(channel_id)
+        self.server = SnapshotEntity(server_id) if server_id is not None else None
+        self.author = SnapshotEntity(author_id, author_name, author_mention)
+        self.content = content
+
+    @staticmethod
+    def from_message(message):
+        return MessageSnapshot(message.channel.id,
+            message.server.id if message.server else None,
+            message.author.id,
+            message.author.name,
+            message.author.mention,
+            message.content)
+
+    def encode(self):
+        return json.dumps({
+            'c': self.channel.id,
+            's': self.server.id if self.server else None,
+            'a': self.author.id,
+            'n': self.author.name,
+            'm': self.author.mention,
+            't': self.content
+        }, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def is_snapshot(raw):
+        return bytes(raw[:1]) == b'{'
+
+    @staticmethod
+    def decode(raw):
+        raw = bytes(raw)
+        if not MessageSnapshot.is_snapshot(raw):
+            #rows written before snapshots existed hold a pickled discord message
+            return pickle.loads(raw)
+        data = json.loads(raw.decode('utf-8'))
+        return MessageSnapshot(data['c'], data['s'], data['a'], data['n'], data['m'], data['t'])
 
 
 class Request():
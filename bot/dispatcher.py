@@ -0,0 +1,49 @@
+import asyncio
+import collections
+import logging
+
+_logger = logging.getLogger()
+
+#runs jobs concurrently, with at most max_workers in flight at once.
+#jobs that share a key (e.g. a channel id) still run one at a time, in the order they were submitted
+class KeyedDispatcher():
+    def __init__(self, maxWorkers, name='dispatcher'):
+        self.max_workers = maxWorkers
+        self.name = name
+        self._semaphore = asyncio.Semaphore(maxWorkers)
+        self._queues = {}
+        self._depth = 0
+
+    def __len__(self):
+        #jobs that are queued or running
+        return self._depth
+
+    def submit(self, key, job):
+        #job is a coroutine function that takes no arguments. errors are logged, not raised
+        queue = self._queues.get(key)
+        self._depth += 1
+        if queue is not None:
+            queue.append(job)
+            return
+        queue = collections.deque([job])
+        self._queues[key] = queue
+        asyncio.ensure_future(self._drain(key, queue))
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                job = queue[0]
+                try:
+                    async with self._semaphore:
+                        await job()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _logger.error("%s job for (%s) failed: %s", self.name, str(key), str(e))
+                    _logger.exception(e)
+                finally:
+                    queue.popleft()
+                    self._depth -= 1
+        finally:
+            if self._queues.get(key) is queue:
+                del self._queues[key]
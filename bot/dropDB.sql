@@ -1,6 +1,8 @@
+DROP TABLE ottobot.tips;
 DROP TABLE ottobot.pendingresponses;
 DROP TABLE ottobot.requests;
 DROP TABLE ottobot.responses;
 DROP TABLE ottobot.commands;
 DROP TABLE ottobot.commandtypes;
+DROP FUNCTION ottobot.notify_command_change();
 DROP SCHEMA ottobot;
@@ -40,7 +40,8 @@ class FunctionExecutor():
         return (result, True)
 
     async def favorite(self, request_id, response_id, message, bot, parser, web):
-        requests = bot.db.get_user_requests(message.author.name)
+        await bot.request_logger.flush()
+        requests = await bot.db.get_user_requests(message.author.name)
         counts = {}
         fav_count = 0
         fav_list = []
@@ -82,7 +83,7 @@ class FunctionExecutor():
             newResponse = dataContainers.Response([-1, split[2], None, None, None, -1])
             if newResponse.text.startswith('!tip'):
                 raise Exception("I'm just a poor :ottoBot: trying to scrape together a living. No need to steal my momocoins")
-            parser.add_command(newCommand, newResponse)
+            await parser.add_command(newCommand, newResponse)
             result = "Added command: " + newCommand.text
         except Exception as e:
             result = "Failed to add command: " + str(e)
@@ -99,14 +100,14 @@ class FunctionExecutor():
             resp_id = [x for x in parser.responses[cmd_id] if parser.responses[cmd_id][x].text == split[2]]
             if len(resp_id) == 0:
                 resp = dataContainers.Response([-1, split[2], None, response_id, None, cmd_id])
-                parser.add_command(parser.commands[cmd_id], resp)
+                await parser.add_command(parser.commands[cmd_id], resp)
                 resp_id = [x for x in parser.responses[cmd_id] if parser.responses[cmd_id][x].text == split[2]][0]
             else:
                 resp_id = resp_id[0]
             delay = float(split[1])
             
             when = datetime.datetime.now() + datetime.timedelta(seconds=delay)
-            new_id = bot.db.insert_pending_response(request_id, resp_id, when, message)
+            new_id = await bot.insert_pending_response(request_id, resp_id, when, message)
             result += " - " + str(new_id)
         except Exception as e:
             result = "Failed to parse delayed response: " + str(e)
@@ -122,7 +123,7 @@ class FunctionExecutor():
         else:
             try:
                 delayed_id = int(split[1])
-                bot.db.delete_pending_response(delayed_id)
+                await bot.delete_pending_response(delayed_id)
                 result = "Da-Cheated"
             except Exception:
                 result = "Failed to parse delayed response id"
@@ -146,7 +147,7 @@ class FunctionExecutor():
                 if parser.commands[c].removable:
                     response = parser.get_response(parser.commands[c].id, index)
                     if response:
-                        parser.delete_response(response)
+                        await parser.delete_response(response)
                         result = "Removed command: " + parser.commands[c].text
                     else:
                         result = "This command doesn't have that many responses"
@@ -164,7 +165,7 @@ class FunctionExecutor():
             response = parser.get_response_by_id(response_id)
             if response:
                 if parser.commands[response.command_id].removable:
-                    parser.delete_response(response)
+                    await parser.delete_response(response)
                     result = "Response deleted"
                 else:
                     result = "That response is not editable"
@@ -268,7 +269,7 @@ class FunctionExecutor():
         delay = random.randrange(minTime, maxTime, 1)
         when = datetime.datetime.now() + datetime.timedelta(seconds=delay)
         next_id = parser.get_response_by_id(response_id).next
-        bot.db.insert_pending_response(request_id, next_id, when, message)
+        await bot.insert_pending_response(request_id, next_id, when, message)
         return ("Want to know the secret to good comedy?", False)
 
     async def timing_pop(self, request_id, response_id, message, bot, parser, web):
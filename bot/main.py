@@ -22,12 +22,18 @@ ensure_future = asyncio.ensure_future
 class OttoBot:
     def __init__(self, token, prefix, connectionString, spamLimit, spamTimeout, display_response_id, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key):
         self.loop = asyncio.get_event_loop()
-        self.web = WebWrapper(self.loop)
+        self.web = WebWrapper(self.loop,
+            globalSettings.config.getint('DEFAULT', 'web_max_in_flight', fallback=16),
+            globalSettings.config.getint('DEFAULT', 'web_max_per_host', fallback=4),
+            globalSettings.config.getint('DEFAULT', 'web_cache_bytes', fallback=4 * 1024 * 1024))
         self.discord = DiscordWrapper(token, self.web, prefix, connectionString, spamLimit, spamTimeout, display_response_id, broker_id, super_user_role, tip_verifier, exchange_rate, tip_command, broker_api_key)
         self.discord_task = None
-        self.web_task = None
         self.response_checker_task = None
         self.status_updater_task = None
+        self.command_sync_task = None
+        self.request_logger_task = None
+        self.test_mode_task = None
+        self.tip_queue_task = None
         self.shutdown_error = False
         self.do_shutdown = False
     
@@ -53,8 +59,12 @@ class OttoBot:
                 pass
 
         self.discord_task = ensure_future(self.discord.start())
-        self.web_task = ensure_future(self.web.run())
         self.response_checker_task = ensure_future(self.discord.check_pending_responses())
+        self.request_logger_task = ensure_future(self.discord.request_logger.run())
+        if self.discord.command_sync:
+            self.command_sync_task = ensure_future(self.discord.command_sync.run())
+        self.test_mode_task = ensure_future(self.discord.start_test_mode_refresher())
+        self.tip_queue_task = ensure_future(self.discord.tip_queue.run())
         if (globalSettings.config.get('DEFAULT', 'btc_status') == 'True'):
             self.status_updater_task = ensure_future(self.discord.start_status_updater())
         
@@ -71,13 +81,33 @@ class OttoBot:
         self.shutdown_error = is_error
         self.do_shutdown = True
         
+        ensure_future(self.shutdown())
+
+    async def shutdown(self):
+        #everything below talks to the database, so it has to stop before the pool is closed
+        background = [task for task in (self.response_checker_task, self.request_logger_task, self.command_sync_task,
+            self.test_mode_task, self.tip_queue_task, self.status_updater_task) if task and not task.done()]
+        for task in background:
+            task.cancel()
+        if background:
+            await asyncio.wait(background, timeout=10)
+
         if self.discord_task and not self.discord_task.done():
-            ensure_future(self.discord.disconnect())
+            await self.discord.disconnect()
+        else:
+            #discord is already gone, but buffered requests still need to make it to the database
+            try:
+                await self.discord.request_logger.close()
+            except Exception:
+                _logger.error("Failed to flush buffered requests")
+            await self.discord.db.close()
     
     async def process(self):
-        task_list = [self.web_task, self.discord_task, self.response_checker_task]
+        task_list = [self.discord_task, self.response_checker_task, self.request_logger_task, self.test_mode_task, self.tip_queue_task]
         if self.status_updater_task:
             task_list.append(self.status_updater_task)
+        if self.command_sync_task:
+            task_list.append(self.command_sync_task)
         while True:
             await asyncio.wait(task_list, return_when=asyncio.ALL_COMPLETED)
             if self.do_shutdown:
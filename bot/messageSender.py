@@ -0,0 +1,73 @@
+from rateLimiter import TokenBucket
+
+import asyncio
+import collections
+import logging
+
+_logger = logging.getLogger()
+
+#per-channel outbound message queue.
+#callers enqueue and move on. each channel drains in order at the rate discord allows (a token bucket
+#per channel), and adjacent short messages to the same channel are merged while they fit in one message
+class MessageSender():
+    def __init__(self, send, maxLength=1500, burst=5, period=5):
+        #send is a coroutine function taking (channel, text), e.g. discord.Client.send_message
+        self.send = send
+        self.max_length = maxLength
+        self.burst = burst
+        self.period = period
+        self._queues = {}
+        self._buckets = {}
+        self._tasks = {}
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def enqueue(self, channel, text):
+        if not text:
+            return
+        key = channel.id
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[key] = queue
+        queue.append(text)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(self._drain(key, channel, queue))
+
+    def _next_message(self, queue):
+        text = queue.popleft()
+        while queue and len(text) + 1 + len(queue[0]) <= self.max_length:
+            text += '\n' + queue.popleft()
+        return text
+
+    async def _drain(self, key, channel, queue):
+        try:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, self.period)
+                self._buckets[key] = bucket
+            while queue:
+                await bucket.take()
+                #merge after waiting, so anything that showed up in the meantime can ride along
+                text = self._next_message(queue)
+                try:
+                    await self.send(channel, text)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _logger.error("Failed to send message to channel (%s): %s", str(key), str(e))
+        finally:
+            del self._tasks[key]
+            if not queue:
+                del self._queues[key]
+                #a full bucket is the same as no bucket, so don't keep it around for idle channels
+                bucket = self._buckets.get(key)
+                if bucket is not None and bucket.is_full():
+                    del self._buckets[key]
+
+    async def flush(self, timeout=10):
+        #wait (up to timeout) for everything queued so far to go out
+        tasks = list(self._tasks.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
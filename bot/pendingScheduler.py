@@ -0,0 +1,109 @@
+from dataContainers import PendingResponse
+
+import asyncio
+import datetime
+import heapq
+import logging
+
+_logger = logging.getLogger()
+
+#min-heap of pending responses keyed on when they should execute.
+#it's loaded from ottobot.pendingresponses once at startup and then fed by schedule(),
+#so the database is only touched when something is actually due
+class PendingResponseScheduler():
+    def __init__(self, db, handler, retryDelay=5):
+        self.db = db
+        #coroutine function that takes the list of pending responses that just came due
+        self.handler = handler
+        #if the handler fails (e.g. the database is briefly unreachable), the same responses are tried again this much later
+        self.retry_delay = retryDelay
+        self._heap = []
+        self._scheduled = set()
+        self._cancelled = set()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    #blocking, for startup before the event loop is running
+    def load(self):
+        self._heap = []
+        self._scheduled = set()
+        self._cancelled = set()
+        migrated = 0
+        for pending in self.db.sync.get_pending_responses(do_log=False):
+            if pending.has_legacy_message:
+                migrated += self._migrate(pending)
+            self._heap.append((pending.execute, pending.id, pending))
+            self._scheduled.add(pending.id)
+        heapq.heapify(self._heap)
+        _logger.info("loaded %s pending responses (%s migrated to message snapshots)", len(self._heap), migrated)
+
+    def _migrate(self, pending):
+        #rewrite a pickled message as a snapshot, so the row only has to be unpickled this once
+        try:
+            self.db.sync.update_pending_response_message(pending.id, self.db.sync.serialize_message(pending.message))
+            return 1
+        except Exception as e:
+            _logger.error("could not migrate message for pending response (%s): %s", str(pending.id), str(e))
+            return 0
+
+    def push(self, pending):
+        heapq.heappush(self._heap, (pending.execute, pending.id, pending))
+        self._scheduled.add(pending.id)
+        #only worth waking up the runner if this is now the next thing due
+        if self._heap[0][1] == pending.id:
+            self._wakeup.set()
+
+    def _requeue(self, pending, when):
+        #back on the heap under a later time. the row itself still has its original execute time
+        heapq.heappush(self._heap, (when, pending.id, pending))
+        self._scheduled.add(pending.id)
+
+    def cancel(self, pending_id):
+        #lazy delete. the entry is skipped when it reaches the top of the heap
+        if pending_id in self._scheduled:
+            self._scheduled.discard(pending_id)
+            self._cancelled.add(pending_id)
+
+    async def schedule(self, request_id, response_id, when, message):
+        serialized = self.db.sync.serialize_message(message)
+        new_id = await self.db.insert_serialized_pending_response(request_id, response_id, when, serialized)
+        self.push(PendingResponse([new_id, request_id, response_id, datetime.datetime.now(), when, serialized]))
+        return new_id
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            execute, pending_id, pending = heapq.heappop(self._heap)
+            if pending_id in self._cancelled:
+                self._cancelled.discard(pending_id)
+                continue
+            self._scheduled.discard(pending_id)
+            due.append(pending)
+        return due
+
+    async def run(self):
+        _logger.info("Starting pending response scheduler")
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(datetime.datetime.now())
+            if due:
+                try:
+                    await self.handler(due)
+                except Exception as e:
+                    #the rows are still in the database, so put them back rather than lose them until a restart.
+                    #anything the handler did get to was already claimed, and won't be claimed a second time
+                    _logger.error("Error handling pending responses, retrying in %ss: %s", self.retry_delay, str(e))
+                    retry_at = datetime.datetime.now() + datetime.timedelta(seconds=self.retry_delay)
+                    for pending in due:
+                        self._requeue(pending, retry_at)
+                continue
+
+            timeout = None
+            if self._heap:
+                timeout = max((self._heap[0][0] - datetime.datetime.now()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
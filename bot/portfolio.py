@@ -0,0 +1,84 @@
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+
+_logger = logging.getLogger()
+
+HUNDRED = Decimal(100)
+CENT = Decimal('.01')
+
+
+def value_positions(positions, cost_key, short=False):
+    #positions is the broker's holdings or shorts dict: symbol -> {'stocks': [lots], 'total_value': ...}.
+    #cost_key is 'purchase_cost' for holdings and 'sell_cost' for shorts.
+    #returns [(symbol, share count, cost basis, market value, percent gain)] in the same order,
+    #with exactly the Decimals the plain Decimal sums would give
+    result = []
+    for symbol, position in positions.items():
+        count, cost = _decimal_totals(position['stocks'], cost_key)
+        value = Decimal(position['total_value'])
+        result.append((symbol, count, cost, value, short_gain(value, cost) if short else long_gain(value, cost)))
+    return result
+
+
+def long_gain(value, cost):
+    return (HUNDRED * (value - cost) / cost).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def short_gain(value, cost):
+    return (HUNDRED * (1 - (value / cost))).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _decimal_totals(lots, cost_key):
+    #count and cost basis in one walk over the lots. same additions in the same order as summing
+    #each column separately, so the result (including its exponent) is identical
+    count = 0
+    cost = 0
+    for lot in lots:
+        lot_count = lot['count']
+        count += lot_count
+        cost += Decimal(lot[cost_key]) * lot_count
+    return count, cost
+
+
+def _benchmark():
+    import random
+    import time
+
+    def make_positions(symbol_count, lots_per_symbol):
+        positions = {}
+        for s in range(symbol_count):
+            lots = []
+            for _ in range(lots_per_symbol):
+                lots.append({
+                    'count': random.randint(1, 500),
+                    'purchase_cost': '{}.{:02d}'.format(random.randint(1, 2000), random.randint(0, 99))
+                })
+            positions['SYM{}'.format(s)] = {'stocks': lots, 'total_value': '{}.{:02d}'.format(random.randint(1, 10 ** 7), random.randint(0, 99))}
+        return positions
+
+    def reference(positions):
+        #what _handle_balance used to do: one pass over the lots for the count, another for the cost
+        result = []
+        for symbol, position in positions.items():
+            lots = position['stocks']
+            count = sum([x['count'] for x in lots])
+            cost = sum([Decimal(x['purchase_cost']) * x['count'] for x in lots])
+            value = Decimal(position['total_value'])
+            result.append((symbol, count, cost, value, long_gain(value, cost)))
+        return result
+
+    paths = [('two pass', reference), ('one pass', lambda p: value_positions(p, 'purchase_cost'))]
+
+    for symbol_count, lots_per_symbol in ((20, 10), (50, 200), (200, 500), (500, 1000)):
+        positions = make_positions(symbol_count, lots_per_symbol)
+        expected = [tuple(str(v) for v in line) for line in reference(positions)]
+        for name, path in paths:
+            start = time.perf_counter()
+            result = path(positions)
+            elapsed = time.perf_counter() - start
+            assert [tuple(str(v) for v in line) for line in result] == expected, name
+            print('{:>4} symbols x {:>4} lots, {:<12} {:.4f}s'.format(symbol_count, lots_per_symbol, name, elapsed))
+
+
+if __name__ == '__main__':
+    _benchmark()
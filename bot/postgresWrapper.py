@@ -2,26 +2,94 @@ from dataContainers import *
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import psycopg2.pool
 
-import datetime
+import asyncio
+import concurrent.futures
+import functools
 import logging
-import pickle
-import copy
+import threading
+import time
 
 _logger = logging.getLogger()
 
 class PostgresWrapper():
-    def __init__(self, connectionString):
+    def __init__(self, connectionString, minConnections=0, maxConnections=0, healthCheckInterval=30):
         self.connection_string = connectionString
-    
+        #pooled mode is only used when a max size is configured. otherwise, connect per query
+        self._pool = None
+        if maxConnections > 0:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(min(minConnections, maxConnections), maxConnections, self.connection_string)
+        #connections that have sat idle longer than this get pinged before they're handed out
+        self.health_check_interval = healthCheckInterval
+        self._last_used = {}
+        self._last_used_lock = threading.Lock()
+
+    def close(self):
+        if self._pool and not self._pool.closed:
+            self._pool.closeall()
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        if connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        with self._last_used_lock:
+            last_used = self._last_used.get(id(connection))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _get_connection(self):
+        if self._pool is None:
+            return psycopg2.connect(self.connection_string)
+        #a freshly opened connection is always healthy, so this only loops while handing out stale ones
+        for _ in range(self._pool.maxconn + 1):
+            connection = self._pool.getconn()
+            if self._is_healthy(connection):
+                return connection
+            _logger.warn("discarding broken pooled database connection")
+            self._release_connection(connection, broken=True)
+        raise psycopg2.OperationalError("Could not get a healthy database connection from the pool")
+
+    def _release_connection(self, connection, broken=False):
+        if connection is None:
+            return
+        if self._pool is None:
+            connection.close()
+            return
+        broken = broken or connection.closed
+        with self._last_used_lock:
+            if broken:
+                self._last_used.pop(id(connection), None)
+            else:
+                self._last_used[id(connection)] = time.monotonic()
+        self._pool.putconn(connection, close=broken)
+
     def _query_wrapper(self, query, vars=[], doFetch=True, do_log=True):
-        retry = True
-        connection = None
-        cursor = None
-        while(retry):
+        attempts = 2
+        for attempt in range(attempts):
+            connection = None
+            cursor = None
             try:
-                connection = psycopg2.connect(self.connection_string)
+                connection = self._get_connection()
                 cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                #nothing has been sent yet, so it's safe to reconnect and try again
+                _logger.error("couldn't get a database connection: " + str(e))
+                self._release_connection(connection, broken=True)
+                if attempt == attempts - 1:
+                    raise e
+                continue
+            try:
                 if do_log:
                     _logger.info('making Query: ' + query)
                     _logger.info('with vars: {}'.format(vars))
@@ -31,16 +99,45 @@ class PostgresWrapper():
                 if(doFetch):
                     result = cursor.fetchall()
                 cursor.close()
-                connection.close()
+                self._release_connection(connection)
                 return result
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                #the connection died with the statement in flight. the server may have committed it anyway,
+                #so running it again could apply it twice. leave that to the caller
+                _logger.error("lost database connection: " + str(e))
+                self._release_connection(connection, broken=True)
+                raise e
             except psycopg2.InternalError as e:
                 cursor.close()
-                connection.close()
+                self._release_connection(connection)
                 if e.pgcode:
                     _logger.error("psycopg2 error code: " + str(e.pgcode))
-                if not retry:
+                if attempt == attempts - 1:
                     raise e
-                retry = False
+            except Exception:
+                self._release_connection(connection)
+                raise
+
+    def _stream_wrapper(self, query, vars=[], do_log=True, itersize=2000):
+        #yields rows from a server side cursor, so big tables never have to sit in memory all at once
+        connection = self._get_connection()
+        broken = False
+        try:
+            cursor = connection.cursor(name='ottobot_stream', cursor_factory=psycopg2.extras.DictCursor)
+            cursor.itersize = itersize
+            if do_log:
+                _logger.info('streaming Query: ' + query)
+                _logger.info('with vars: {}'.format(vars))
+            cursor.execute(query, vars)
+            for row in cursor:
+                yield row
+            cursor.close()
+            connection.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._release_connection(connection, broken=broken)
 
     def get_active_commands(self, do_log=True):
         rawVals = self._query_wrapper("SELECT * FROM ottobot.commands WHERE active;", do_log=do_log)
@@ -49,8 +146,15 @@ class PostgresWrapper():
             result.append(Command(raw))
         return result
 
-    def get_recent_requests(self, user, when):
-        rawVals = self._query_wrapper("SELECT * FROM ottobot.requests WHERE requestedby=%s AND requested >= timestamp %s;", [user, when])
+    def get_commands(self, commandIDs, do_log=True):
+        rawVals = self._query_wrapper("SELECT * FROM ottobot.commands WHERE id = ANY(%s);", [list(commandIDs)], do_log=do_log)
+        result = []
+        for raw in rawVals:
+            result.append(Command(raw))
+        return result
+
+    def get_requests_since(self, when, do_log=True):
+        rawVals = self._query_wrapper("SELECT * FROM ottobot.requests WHERE requested >= timestamp %s ORDER BY requested;", [when], do_log=do_log)
         result = []
         for raw in rawVals:
             result.append(Request(raw))
@@ -63,17 +167,26 @@ class PostgresWrapper():
             result.append(Request(raw))
         return result
 
-    def get_request(self, request_id):
-        return Request(self._query_wrapper("SELECT * FROM ottobot.requests WHERE id=%s;", [request_id])[0])
-
-    def get_ready_pending_responses(self):
-        #ignore logging on this one query because it happens every 15s
-        rawVals = self._query_wrapper("SELECT * FROM ottobot.pendingresponses WHERE execute <= now();", do_log=False)
+    def get_pending_responses(self, do_log=True):
+        rawVals = self._query_wrapper("SELECT * FROM ottobot.pendingresponses;", do_log=do_log)
         result = []
         for raw in rawVals:
             result.append(PendingResponse(raw))
         return result
 
+    def claim_pending_responses(self, pendingResponseIDs, do_log=True):
+        #deletes the rows and hands them back joined with their requests, all in one statement.
+        #rows another bot instance already has locked are skipped, so nothing fires twice
+        rawVals = self._query_wrapper("""DELETE FROM ottobot.pendingresponses p USING ottobot.requests r
+            WHERE p.requestid = r.id AND p.id IN (
+                SELECT id FROM ottobot.pendingresponses WHERE id = ANY(%s) FOR UPDATE SKIP LOCKED)
+            RETURNING p.id, p.requestid, p.nextresponse, p.stored, p.execute, p.message,
+                r.id, r.commandid, r.requested, r.requestedby;""", [list(pendingResponseIDs)], do_log=do_log)
+        result = []
+        for raw in rawVals:
+            result.append((PendingResponse(raw[0:6]), Request(raw[6:10])))
+        return result
+
     def get_responses(self, commandID, do_log=True):
         rawVals = self._query_wrapper("SELECT * FROM ottobot.responses WHERE commandid=%s;", [commandID], do_log=do_log)
         result = []
@@ -81,6 +194,19 @@ class PostgresWrapper():
             result.append(Response(raw))
         return result
 
+    def get_responses_for_commands(self, commandIDs, do_log=True):
+        rawVals = self._query_wrapper("SELECT * FROM ottobot.responses WHERE commandid = ANY(%s);", [list(commandIDs)], do_log=do_log)
+        result = []
+        for raw in rawVals:
+            result.append(Response(raw))
+        return result
+
+    def stream_active_responses(self, do_log=True):
+        #every response belonging to an active command, in one round trip
+        query = "SELECT r.* FROM ottobot.responses r JOIN ottobot.commands c ON c.id = r.commandid WHERE c.active;"
+        for raw in self._stream_wrapper(query, do_log=do_log):
+            yield Response(raw)
+
     def get_command_types(self, do_log=True):
         rawVals = self._query_wrapper("SELECT * FROM ottobot.commandtypes;", do_log=do_log)
         result = []
@@ -88,14 +214,38 @@ class PostgresWrapper():
             result.append(CommandType(raw))
         return result
 
-    def insert_request(self, user, commandID):
-        return self._query_wrapper("INSERT INTO ottobot.requests (requestedby, requested, commandid) values (%s, %s, %s) RETURNING id;", [user, datetime.datetime.now(), commandID])[0][0]
+    def open_listener(self, channel):
+        #dedicated connection for LISTEN. it lives outside the pool since it never goes back in
+        connection = psycopg2.connect(self.connection_string)
+        connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = connection.cursor()
+        cursor.execute("LISTEN " + channel + ";")
+        cursor.close()
+        return connection
+
+    def reserve_request_ids(self, count):
+        rawVals = self._query_wrapper("SELECT nextval('ottobot.requests_id_seq') FROM generate_series(1, %s);", [count], do_log=False)
+        return [raw[0] for raw in rawVals]
+
+    def insert_requests(self, rows):
+        #rows are (id, requestedby, requested, commandid), with ids from reserve_request_ids
+        values = ", ".join(["(%s, %s, %s, %s)"] * len(rows))
+        vars = [val for row in rows for val in row]
+        #a batch whose commit landed without us hearing back is written again by the retry, so skip ids already there
+        self._query_wrapper("INSERT INTO ottobot.requests (id, requestedby, requested, commandid) values " + values + " ON CONFLICT (id) DO NOTHING;", vars, doFetch=False, do_log=False)
+
+    @staticmethod
+    def serialize_message(message):
+        if not isinstance(message, MessageSnapshot):
+            message = MessageSnapshot.from_message(message)
+        return message.encode()
 
-    def insert_pending_response(self, requestID, lastResponse, when, message):
-        message = copy.deepcopy(message)
-        message = pickle.dumps(message)
+    def insert_serialized_pending_response(self, requestID, lastResponse, when, message):
         return self._query_wrapper("INSERT INTO ottobot.pendingresponses (requestid, nextresponse, execute, stored, message) values(%s, %s, %s, now(), %s) RETURNING id;", [requestID, lastResponse, when, message])[0][0]
 
+    def update_pending_response_message(self, pendingResponseID, message):
+        self._query_wrapper("UPDATE ottobot.pendingresponses SET message=%s WHERE id=%s;", [message, pendingResponseID], doFetch=False, do_log=False)
+
     def insert_response(self, text, function, previous, commandID):
         result = self._query_wrapper("INSERT INTO ottobot.responses (text, functionname, next, previous, commandid) values (%s, %s, NULL, %s, %s) RETURNING id;", [text, function, previous, commandID])[0][0]
         self._query_wrapper("UPDATE ottobot.responses SET next=%s where commandid=%s and next IS NULL and id!=%s;", [result, commandID, result], doFetch=False)
@@ -113,4 +263,128 @@ class PostgresWrapper():
         self._query_wrapper("DELETE FROM ottobot.responses WHERE id=%s;", [responseID], doFetch=False)
 
     def delete_pending_response(self, pendingResponseID):
-        self._query_wrapper("DELETE FROM ottobot.pendingresponses WHERE id=%s;", [pendingResponseID], doFetch=False)
\ No newline at end of file
+        self._query_wrapper("DELETE FROM ottobot.pendingresponses WHERE id=%s;", [pendingResponseID], doFetch=False)
+
+    def insert_tip(self, messageID, channelID, content):
+        #True if the tip is new. the message id is the key, so a tip we've already seen is left alone
+        return len(self._query_wrapper("""INSERT INTO ottobot.tips (messageid, channelid, content, status, received)
+            values (%s, %s, %s, 'queued', now()) ON CONFLICT (messageid) DO NOTHING RETURNING messageid;""", [messageID, channelID, content])) > 0
+
+    def claim_tips(self, limit, do_log=False):
+        #moves the oldest queued tips that are due to processing, and hands them back as
+        #(message id, channel id, content, attempt). the attempt number is the claim's token: the later
+        #updates only apply while it still matches. rows another instance has locked are skipped
+        rawVals = self._query_wrapper("""UPDATE ottobot.tips SET status='processing', attempts=attempts + 1, claimed=now()
+            WHERE messageid IN (
+                SELECT messageid FROM ottobot.tips WHERE status='queued' AND nextattempt <= now()
+                ORDER BY received LIMIT %s FOR UPDATE SKIP LOCKED)
+            RETURNING messageid, channelid, content, attempts;""", [limit], do_log=do_log)
+        return [(raw[0], raw[1], raw[2], raw[3]) for raw in rawVals]
+
+    def mark_tip_depositing(self, messageID, attempt):
+        #False if the claim was lost (e.g. recovered as stale and picked up again)
+        return len(self._query_wrapper("""UPDATE ottobot.tips SET status='depositing'
+            WHERE messageid=%s AND attempts=%s AND status='processing' RETURNING messageid;""", [messageID, attempt])) > 0
+
+    def finish_tip(self, messageID, attempt, status, retryDelay=0):
+        #retryDelay only matters when status is 'queued'. False if the claim was lost
+        return len(self._query_wrapper("""UPDATE ottobot.tips SET status=%s, processed=now(), nextattempt=now() + %s * interval '1 second'
+            WHERE messageid=%s AND attempts=%s AND status IN ('processing', 'depositing') RETURNING messageid;""",
+            [status, retryDelay, messageID, attempt])) > 0
+
+    def recover_tips(self, staleAfter):
+        #tips claimed more than staleAfter seconds ago belong to a worker that died. ones that hadn't started
+        #their deposit go back in the queue. ones that had need a person to check with the broker.
+        #returns (requeued, sent to review)
+        requeued = self._query_wrapper("""UPDATE ottobot.tips SET status='queued'
+            WHERE status='processing' AND claimed < now() - %s * interval '1 second' RETURNING messageid;""", [staleAfter], do_log=False)
+        review = self._query_wrapper("""UPDATE ottobot.tips SET status='review'
+            WHERE status='depositing' AND claimed < now() - %s * interval '1 second' RETURNING messageid;""", [staleAfter], do_log=False)
+        return len(requeued), len(review)
+
+#awaitable mirror of PostgresWrapper. every query is handed to a bounded thread pool
+#so the event loop (discord heartbeat, web queue, other guilds) keeps running while we wait on postgres
+class AsyncPostgresWrapper():
+    def __init__(self, db, loop=None, maxWorkers=4):
+        self.sync = db
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+
+    def _run(self, func, *args, **kwargs):
+        loop = self.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        #shutting the pool down waits on any query still running, so do the waiting off the loop
+        loop = self.loop or asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._close)
+
+    def _close(self):
+        self.executor.shutdown(wait=True)
+        self.sync.close()
+
+    async def get_active_commands(self, do_log=True):
+        return await self._run(self.sync.get_active_commands, do_log=do_log)
+
+    async def get_commands(self, commandIDs, do_log=True):
+        return await self._run(self.sync.get_commands, commandIDs, do_log=do_log)
+
+    async def get_user_requests(self, user):
+        return await self._run(self.sync.get_user_requests, user)
+
+    async def claim_pending_responses(self, pendingResponseIDs, do_log=True):
+        return await self._run(self.sync.claim_pending_responses, pendingResponseIDs, do_log=do_log)
+
+    async def get_responses(self, commandID, do_log=True):
+        return await self._run(self.sync.get_responses, commandID, do_log=do_log)
+
+    async def get_responses_for_commands(self, commandIDs, do_log=True):
+        return await self._run(self.sync.get_responses_for_commands, commandIDs, do_log=do_log)
+
+    async def get_active_responses(self, do_log=True):
+        return await self._run(lambda: list(self.sync.stream_active_responses(do_log=do_log)))
+
+    async def get_command_types(self, do_log=True):
+        return await self._run(self.sync.get_command_types, do_log=do_log)
+
+    async def open_listener(self, channel):
+        return await self._run(self.sync.open_listener, channel)
+
+    async def reserve_request_ids(self, count):
+        return await self._run(self.sync.reserve_request_ids, count)
+
+    async def insert_requests(self, rows):
+        return await self._run(self.sync.insert_requests, rows)
+
+    async def insert_serialized_pending_response(self, requestID, lastResponse, when, message):
+        return await self._run(self.sync.insert_serialized_pending_response, requestID, lastResponse, when, message)
+
+    async def insert_response(self, text, function, previous, commandID):
+        return await self._run(self.sync.insert_response, text, function, previous, commandID)
+
+    async def insert_command(self, text, removable, caseSensitive, commandTypeID):
+        return await self._run(self.sync.insert_command, text, removable, caseSensitive, commandTypeID)
+
+    async def deactivate_command(self, commandID):
+        return await self._run(self.sync.deactivate_command, commandID)
+
+    async def delete_response(self, responseID, next, previous):
+        return await self._run(self.sync.delete_response, responseID, next, previous)
+
+    async def delete_pending_response(self, pendingResponseID):
+        return await self._run(self.sync.delete_pending_response, pendingResponseID)
+
+    async def insert_tip(self, messageID, channelID, content):
+        return await self._run(self.sync.insert_tip, messageID, channelID, content)
+
+    async def claim_tips(self, limit, do_log=False):
+        return await self._run(self.sync.claim_tips, limit, do_log=do_log)
+
+    async def mark_tip_depositing(self, messageID, attempt):
+        return await self._run(self.sync.mark_tip_depositing, messageID, attempt)
+
+    async def finish_tip(self, messageID, attempt, status, retryDelay=0):
+        return await self._run(self.sync.finish_tip, messageID, attempt, status, retryDelay)
+
+    async def recover_tips(self, staleAfter):
+        return await self._run(self.sync.recover_tips, staleAfter)
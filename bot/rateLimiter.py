@@ -0,0 +1,99 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+_logger = logging.getLogger()
+
+#allows at most `limit` hits per key in any `window` seconds.
+#only the last `limit` hits of each key are remembered, and keys that have been quiet
+#for a whole window are dropped, so memory stays bounded by the number of active users
+class SlidingWindowLimiter():
+    def __init__(self, limit, window, maxKeys=10000):
+        self.limit = limit
+        self.window = datetime.timedelta(seconds=window)
+        self.max_keys = maxKeys
+        #key -> recent hit times, ordered by each key's latest hit
+        self._hits = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._hits)
+
+    def _evict_idle(self, now):
+        cutoff = now - self.window
+        while self._hits:
+            key, hits = next(iter(self._hits.items()))
+            if hits and hits[-1] >= cutoff:
+                break
+            del self._hits[key]
+
+    def _record(self, key, when):
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = collections.deque(maxlen=self.limit)
+            self._hits[key] = hits
+        hits.append(when)
+        self._hits.move_to_end(key)
+        if len(self._hits) > self.max_keys:
+            self._hits.popitem(last=False)
+
+    def allow(self, key, now=None):
+        #records the hit and returns True if the key is under its limit, otherwise returns False
+        if now is None:
+            now = datetime.datetime.now()
+        self._evict_idle(now)
+        hits = self._hits.get(key)
+        if hits is not None:
+            cutoff = now - self.window
+            while hits and hits[0] < cutoff:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+        elif self.limit <= 0:
+            return False
+        self._record(key, now)
+        return True
+
+    def warm(self, hits):
+        #hits is an iterable of (key, when) in chronological order, e.g. from the requests table
+        count = 0
+        for key, when in hits:
+            self._record(key, when)
+            count += 1
+        _logger.info("warmed rate limiter with %s hits for %s keys", count, len(self._hits))
+
+
+#classic token bucket. holds up to `capacity` tokens and refills `capacity` of them every `period` seconds
+class TokenBucket():
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self, now=None):
+        #takes a token if one is available. otherwise returns how many seconds until one will be
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    async def take(self):
+        wait = self.try_take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.try_take()
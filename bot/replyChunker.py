@@ -0,0 +1,113 @@
+import logging
+
+_logger = logging.getLogger()
+
+FENCE = '```'
+#how much of a fence's info string (the language tag) gets repeated when a block is reopened
+MAX_FENCE_INFO = 16
+
+
+def split_reply(text, max_length):
+    #splits text into pieces no longer than max_length, in one pass over the string.
+    #prefers to break on a newline, then on a space, and only cuts mid-word as a last resort.
+    #a ``` code block that spans a break is closed at the end of one piece and reopened
+    #(with the same language tag) at the start of the next, so each piece renders on its own
+    return [prefix + text[start:end] + suffix for prefix, start, end, suffix in _split(text, max_length)]
+
+
+def _split(text, max_length):
+    #yields (added prefix, start, end, added suffix). the text[start:end] slices cover text in order,
+    #apart from the single newline or space each break was made on
+    length = len(text)
+    has_fences = FENCE in text
+    #room for the "\n```" that closes a block we're splitting. reserved every time, since a block
+    #can open anywhere in the piece
+    closing = len(FENCE) + 1 if has_fences else 0
+    pos = 0
+    fence_open = None
+
+    while True:
+        decorate = True
+        prefix = ''
+        if fence_open is not None:
+            prefix = fence_open + '\n'
+            if max_length - len(prefix) - closing <= 0:
+                #no room for the language tag. reopen the block without it
+                prefix = FENCE + '\n'
+        budget = max_length - len(prefix) - closing
+        if budget <= 0:
+            #too small to wrap anything in a fence. send the text as is, but keep tracking
+            #fences so the open/closed state stays right for later pieces
+            decorate = False
+            prefix = ''
+            budget = max_length
+
+        if length - pos <= budget:
+            end = length
+            next_pos = length
+        else:
+            limit = pos + budget
+            end = text.rfind('\n', pos + 1, limit + 1)
+            if end == -1:
+                end = text.rfind(' ', pos + 1, limit + 1)
+            if end == -1:
+                end = limit
+                #don't cut a ``` in half
+                marker = text.rfind(FENCE, end - len(FENCE) + 1, end + len(FENCE) - 1)
+                if marker > pos:
+                    end = marker
+                next_pos = end
+            else:
+                #drop the character we broke on
+                next_pos = end + 1
+
+        fence_open = _scan_fences(text, pos, end, fence_open)
+        suffix = '\n' + FENCE if decorate and fence_open is not None and end < length else ''
+        yield prefix, pos, end, suffix
+        if next_pos >= length:
+            break
+        pos = next_pos
+
+
+def _scan_fences(text, start, end, fence_open):
+    #returns the opening marker (plus a short info string) of the fence that's still open at `end`, or None
+    i = text.find(FENCE, start, end)
+    while i != -1:
+        if fence_open is None:
+            info_start = i + len(FENCE)
+            info_end = info_start
+            stop = min(end, info_start + MAX_FENCE_INFO)
+            while info_end < stop and not text[info_end].isspace() and text[info_end] != '`':
+                info_end += 1
+            fence_open = text[i:info_end]
+        else:
+            fence_open = None
+        i = text.find(FENCE, i + len(FENCE), end)
+    return fence_open
+
+
+def _benchmark():
+    import random
+    import time
+
+    lines = []
+    for i in range(200000):
+        if i % 500 == 0:
+            lines.append(FENCE + 'py')
+        elif i % 500 == 250:
+            lines.append(FENCE)
+        else:
+            lines.append(' '.join('word{}'.format(random.randint(0, 1000)) for _ in range(random.randint(0, 12))))
+    text = '\n'.join(lines)
+
+    for size in (len(text) // 8, len(text) // 2, len(text)):
+        sample = text[:size]
+        start = time.perf_counter()
+        chunks = split_reply(sample, 1500)
+        elapsed = time.perf_counter() - start
+        assert max(len(c) for c in chunks) <= 1500
+        print('{:>10,} chars -> {:>6,} chunks in {:.3f}s'.format(len(sample), len(chunks), elapsed))
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import datetime
+import logging
+
+import psycopg2
+
+_logger = logging.getLogger()
+
+#write-behind buffer for ottobot.requests.
+#ids are reserved from the table's sequence in blocks, so log() can hand one out right away,
+#and the rows themselves get written in batches once enough pile up or enough time passes
+class RequestLogger():
+    def __init__(self, db, batchSize=50, flushInterval=2, idBlockSize=50):
+        self.db = db
+        self.batch_size = batchSize
+        self.flush_interval = flushInterval
+        self.id_block_size = idBlockSize
+        self._ids = collections.deque()
+        self._buffer = []
+        self._id_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    async def _next_id(self):
+        while not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    self._ids.extend(await self.db.reserve_request_ids(self.id_block_size))
+        return self._ids.popleft()
+
+    async def log(self, user, command_id):
+        request_id = await self._next_id()
+        self._buffer.append((request_id, user, datetime.datetime.now(), command_id))
+        if len(self._buffer) >= self.batch_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self._flush_quietly())
+        return request_id
+
+    async def flush(self):
+        #anything that needs to see the rows in the database (foreign keys, reports) should await this first
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows = self._buffer
+            self._buffer = []
+            try:
+                await self.db.insert_requests(rows)
+            except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                #retrying won't help these. write the rows one at a time so a bad one doesn't take the batch with it
+                _logger.error("Batch of %s requests was rejected, writing them one at a time: %s", len(rows), str(e))
+                await self._insert_each(rows)
+            except Exception:
+                #put them back in front of anything logged in the meantime, and let the next flush retry
+                self._buffer = rows + self._buffer
+                raise
+
+    async def _insert_each(self, rows):
+        for i, row in enumerate(rows):
+            try:
+                await self.db.insert_requests([row])
+            except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                _logger.error("Dropping request %s that the database won't take: %s", row, str(e))
+            except Exception:
+                self._buffer = rows[i:] + self._buffer
+                raise
+
+    async def _flush_quietly(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            _logger.error("Failed to flush %s buffered requests: %s", len(self._buffer), str(e))
+
+    async def run(self):
+        _logger.info("Starting request logger")
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush_quietly()
+
+    async def close(self):
+        _logger.info("Flushing %s buffered requests", len(self._buffer))
+        await self.flush()
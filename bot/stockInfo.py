@@ -1,6 +1,5 @@
 from webWrapper import RestWrapper
 
-import json
 import logging
 import datetime
 import pytz
@@ -11,7 +10,8 @@ _logger = logging.getLogger()
 class StockInfo():
     def __init__(self, webWrapper):
         self.rest = RestWrapper(webWrapper,
-            "https://api.iextrading.com/1.0", {})
+            "https://api.iextrading.com/1.0", {}, 'stocks',
+            cacheTTLs=[('/stock/*/quote', 5), ('/stock/*/chart*', 300)])
         self.date_time_format = '%Y-%m-%d %H:%M:%S'
         self.date_format = '%Y-%m-%d'
         self.error_key = 'Error'
@@ -87,7 +87,7 @@ class StockInfo():
             unparsed = await response.text()
             data = None
             try:
-                data = json.loads(unparsed)
+                data = await response.json()
             except Exception:
                 pass
             if data is None:
@@ -134,7 +134,7 @@ class StockInfo():
             unparsed = await response.text()
             data = None
             try:
-                data = json.loads(unparsed)
+                data = await response.json()
             except Exception:
                 pass
             if data is None:
@@ -194,7 +194,7 @@ class StockInfo():
             unparsed = await response.text()
             data = None
             try:
-                data = json.loads(unparsed)
+                data = await response.json()
             except Exception:
                 pass
             if data is None:
@@ -232,7 +232,7 @@ class StockInfo():
             unparsed = await response.text()
             data = None
             try:
-                data = json.loads(unparsed)
+                data = await response.json()
             except Exception:
                 pass
             if data is None:
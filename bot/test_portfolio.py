@@ -0,0 +1,67 @@
+import random
+import unittest
+from decimal import Decimal
+
+from portfolio import long_gain, short_gain, value_positions
+
+
+def _random_cost(rng):
+    roll = rng.random()
+    if roll < 0.05:
+        return '-{}.{:02d}'.format(rng.randint(0, 500), rng.randint(0, 99))
+    elif roll < 0.1:
+        return str(rng.randint(10 ** 15, 10 ** 20)) + '.' + str(rng.randint(0, 9999))
+    elif roll < 0.15:
+        return rng.choice(['1E+2', '.5', '12.', '0.0000001', '3'])
+    places = rng.randint(0, 6)
+    whole = str(rng.randint(0, 5000))
+    if not places:
+        return whole
+    return whole + '.' + ''.join(str(rng.randint(0, 9)) for _ in range(places))
+
+
+def _random_positions(rng, symbols=20, max_lots=50):
+    positions = {}
+    for s in range(symbols):
+        lots = []
+        for _ in range(rng.randint(1, max_lots)):
+            lots.append({
+                'count': rng.randint(0, 10 ** rng.randint(0, 6)),
+                'purchase_cost': _random_cost(rng),
+            })
+        positions['SYM{}'.format(s)] = {'stocks': lots, 'total_value': '{}.{:02d}'.format(rng.randint(1, 10 ** 7), rng.randint(0, 99))}
+    return positions
+
+
+def _two_pass(positions, short):
+    #what _handle_balance did before value_positions
+    result = []
+    for symbol, position in positions.items():
+        lots = position['stocks']
+        count = sum([x['count'] for x in lots])
+        cost = sum([Decimal(x['purchase_cost']) * x['count'] for x in lots])
+        value = Decimal(position['total_value'])
+        result.append((symbol, count, cost, value, short_gain(value, cost) if short else long_gain(value, cost)))
+    return result
+
+
+class ValuePositionsTest(unittest.TestCase):
+    def test_matches_two_pass_sums(self):
+        rng = random.Random(4321)
+        for _ in range(200):
+            positions = _random_positions(rng)
+            for short in (False, True):
+                try:
+                    expected = _two_pass(positions, short)
+                except ArithmeticError:
+                    #a zero cost basis has no percent gain either way
+                    with self.assertRaises(ArithmeticError):
+                        value_positions(positions, 'purchase_cost', short)
+                    continue
+                actual = value_positions(positions, 'purchase_cost', short)
+                #str compares the exponent too, so 1.50 and 1.5 don't count as the same answer
+                self.assertEqual([tuple(str(v) for v in line) for line in actual], [tuple(str(v) for v in line) for line in expected])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import random
+import unittest
+
+from replyChunker import FENCE, _split, split_reply
+
+
+def _random_text(rng):
+    lines = []
+    for _ in range(rng.randint(0, 60)):
+        roll = rng.random()
+        if roll < 0.1:
+            lines.append(FENCE + rng.choice(['', 'py', 'javascript', 'averyveryverylonglanguagename']))
+        elif roll < 0.2:
+            lines.append(FENCE)
+        elif roll < 0.25:
+            #a whole block on one line
+            lines.append(FENCE + ' '.join('w{}'.format(rng.randint(0, 99)) for _ in range(rng.randint(1, 80))) + FENCE)
+        elif roll < 0.3:
+            #long enough to force a cut mid word
+            lines.append('x' * rng.randint(50, 400))
+        else:
+            lines.append(' '.join('word{}'.format(rng.randint(0, 999)) for _ in range(rng.randint(0, 20))))
+    return '\n'.join(lines)
+
+
+class SplitReplyTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1234)
+
+    def test_chunks_fit(self):
+        for _ in range(300):
+            text = _random_text(self.rng)
+            max_length = self.rng.choice([1, 2, 3, 5, 8, 12, 20, 40, 100, 500, 1500])
+            for chunk in split_reply(text, max_length):
+                self.assertLessEqual(len(chunk), max_length)
+
+    def test_fences_balanced(self):
+        for _ in range(300):
+            text = _random_text(self.rng)
+            #only fences the input closed itself can be left unbalanced at the very end
+            if text.count(FENCE) % 2:
+                text += '\n' + FENCE
+            max_length = self.rng.choice([30, 40, 100, 500, 1500])
+            for chunk in split_reply(text, max_length):
+                self.assertEqual(chunk.count(FENCE) % 2, 0, chunk)
+
+    def test_round_trip(self):
+        for _ in range(300):
+            text = _random_text(self.rng)
+            max_length = self.rng.choice([1, 3, 8, 20, 40, 100, 1500])
+            pos = 0
+            for prefix, start, end, suffix in _split(text, max_length):
+                if start != pos:
+                    #the break was made on a newline or space, which is dropped
+                    self.assertEqual(start, pos + 1)
+                    self.assertIn(text[pos], '\n ')
+                if text:
+                    self.assertLess(start, end)
+                pos = end
+            if pos == len(text) - 1:
+                #a break on the very last character leaves nothing to put in another piece
+                self.assertIn(text[pos], '\n ')
+                pos += 1
+            self.assertEqual(pos, len(text))
+
+    def test_one_line_block_isnt_repeated(self):
+        text = FENCE + 'word ' * 400 + FENCE + '\n' + 'more text ' * 50
+        chunks = split_reply(text, 1500)
+        self.assertEqual(len(chunks), 2)
+        self.assertTrue(chunks[1].startswith(FENCE + 'word\n'))
+
+    def test_short_text_untouched(self):
+        self.assertEqual(split_reply('hello', 1500), ['hello'])
+        self.assertEqual(split_reply('', 1500), [''])
+
+
+if __name__ == '__main__':
+    unittest.main()
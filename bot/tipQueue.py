@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import logging
+
+_logger = logging.getLogger()
+
+#durable queue of tip messages, backed by ottobot.tips.
+#the discord message id is the row's key, so seeing the same tip twice (reconnects, replays) only queues it once.
+#a row goes queued -> processing -> depositing -> done. anything that fails before depositing goes back in the
+#queue (a few times, with backoff). once a deposit has been attempted, a failure we can't explain goes to
+#review for somebody to check with the broker, rather than risk paying out twice
+class TipQueue():
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    DEPOSITING = 'depositing'
+    DONE = 'done'
+    FAILED = 'failed'
+    REVIEW = 'review'
+    #longest wait between attempts to store a tip while the database is unreachable
+    MAX_QUEUE_DELAY = 60
+
+    def __init__(self, db, broker, reply, batchSize=10, pollInterval=30, maxAttempts=5, retryDelay=10, staleAfter=300):
+        self.db = db
+        self.broker = broker
+        #coroutine function taking (channel id, text)
+        self.reply = reply
+        self.batch_size = batchSize
+        #also check every so often, for rows queued by another instance, retries coming due,
+        #and claims left behind by a worker that died
+        self.poll_interval = pollInterval
+        self.max_attempts = maxAttempts
+        #doubles with every attempt
+        self.retry_delay = retryDelay
+        self.stale_after = staleAfter
+        self._wakeup = asyncio.Event()
+
+    async def enqueue(self, message):
+        #keeps trying until the tip is stored, since giving up would lose somebody's money.
+        #it isn't processed inline instead: an insert that reported an error may still have committed,
+        #and then the worker would deposit it a second time
+        delay = 1
+        while True:
+            try:
+                if await self.db.insert_tip(message.id, message.channel.id, message.content):
+                    self._wakeup.set()
+                else:
+                    _logger.info("tip message (%s) was already queued. ignoring", str(message.id))
+                return
+            except asyncio.CancelledError:
+                _logger.error("Gave up queueing tip:(%s) on shutdown", message.content)
+                raise
+            except Exception as e:
+                _logger.error("Failed to queue tip:(%s), trying again in %ss: %s", message.content, delay, str(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_QUEUE_DELAY)
+
+    async def run(self):
+        _logger.info("Starting tip queue")
+        await self._recover()
+        while True:
+            self._wakeup.clear()
+            try:
+                tips = await self.db.claim_tips(self.batch_size)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _logger.error("Couldn't claim queued tips: %s", str(e))
+                tips = []
+
+            for tip in tips:
+                await self._process(tip)
+
+            if len(tips) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    await self._recover()
+
+    async def _recover(self):
+        try:
+            requeued, review = await self.db.recover_tips(self.stale_after)
+            if requeued:
+                _logger.warn("%s tips were abandoned before their deposit and have been queued again", requeued)
+            if review:
+                _logger.error("%s tips were abandoned mid deposit and need to be checked by hand (status '%s')", review, self.REVIEW)
+        except Exception as e:
+            _logger.error("Couldn't check for abandoned tips: %s", str(e))
+
+    async def _mark_depositing(self, message_id, attempt):
+        if not await self.db.mark_tip_depositing(message_id, attempt):
+            raise Exception('tip ({}) is no longer ours to deposit'.format(message_id))
+
+    async def _process(self, tip):
+        message_id, channel_id, content, attempt = tip
+        reply, outcome = await self.broker.process_tip(content, functools.partial(self._mark_depositing, message_id, attempt))
+
+        delay = 0
+        if outcome == self.broker.TIP_DONE:
+            status = self.DONE
+        elif outcome == self.broker.TIP_RETRY and attempt < self.max_attempts:
+            status = self.QUEUED
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            _logger.info("tip (%s) failed attempt %s of %s, retrying in %ss", str(message_id), attempt, self.max_attempts, delay)
+            #only tell them once we've given up
+            reply = None
+        elif outcome == self.broker.TIP_RETRY:
+            status = self.FAILED
+        else:
+            status = self.REVIEW
+            _logger.error("tip (%s) needs to be checked by hand (status '%s')", str(message_id), self.REVIEW)
+
+        try:
+            if not await self.db.finish_tip(message_id, attempt, status, delay):
+                _logger.warn("tip (%s) was taken over by another worker. leaving it to them", str(message_id))
+                return
+        except Exception as e:
+            #the row stays claimed, and gets picked up again (or sent to review) once it goes stale
+            _logger.error("Couldn't record tip (%s) as %s: %s", str(message_id), status, str(e))
+        if reply:
+            try:
+                await self.reply(channel_id, reply)
+            except Exception as e:
+                _logger.error("Couldn't reply to tip (%s): %s", str(message_id), str(e))
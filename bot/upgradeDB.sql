@@ -0,0 +1,41 @@
+-- brings an existing database up to date with createDB.sql. safe to run more than once
+CREATE OR REPLACE FUNCTION ottobot.notify_command_change() RETURNS trigger AS $$
+DECLARE
+    changed_command int;
+BEGIN
+    IF TG_TABLE_NAME = 'commands' THEN
+        IF TG_OP = 'DELETE' THEN
+            changed_command := OLD.id;
+        ELSE
+            changed_command := NEW.id;
+        END IF;
+    ELSE
+        IF TG_OP = 'DELETE' THEN
+            changed_command := OLD.commandid;
+        ELSE
+            changed_command := NEW.commandid;
+        END IF;
+    END IF;
+    PERFORM pg_notify('ottobot_commands', changed_command::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS commands_changed ON ottobot.commands;
+CREATE TRIGGER commands_changed AFTER INSERT OR UPDATE OR DELETE ON ottobot.commands
+    FOR EACH ROW EXECUTE PROCEDURE ottobot.notify_command_change();
+DROP TRIGGER IF EXISTS responses_changed ON ottobot.responses;
+CREATE TRIGGER responses_changed AFTER INSERT OR UPDATE OR DELETE ON ottobot.responses
+    FOR EACH ROW EXECUTE PROCEDURE ottobot.notify_command_change();
+CREATE TABLE IF NOT EXISTS ottobot.tips(
+    messageid varchar(64) NOT NULL,
+    channelid varchar(64) NOT NULL,
+    content text NOT NULL,
+    status varchar(16) NOT NULL,
+    attempts int NOT NULL DEFAULT 0,
+    received timestamp NOT NULL,
+    nextattempt timestamp NOT NULL DEFAULT now(),
+    claimed timestamp,
+    processed timestamp,
+    PRIMARY KEY(messageid)
+);
+CREATE INDEX IF NOT EXISTS tips_queued ON ottobot.tips(received) WHERE status = 'queued';
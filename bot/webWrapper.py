@@ -1,41 +1,181 @@
 import aiohttp
 import asyncio
 import async_timeout
+import bisect
+import collections
+import fnmatch
+import itertools
+import json
 import urllib
-import urllib.request
+import urllib.parse
 import logging
+import time
 
 _logger = logging.getLogger()
 
+#what's left of an http response once its body has been read. unlike the aiohttp response,
+#it holds no connection, so it's cheap to cache and share between callers
+class WebResponse():
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        self._json = None
+        self._parsed = False
+
+    async def text(self):
+        return self.body
+
+    async def json(self):
+        #parsed once and shared, so treat the result as read only
+        if not self._parsed:
+            self._json = json.loads(self.body)
+            self._parsed = True
+        return self._json
+
+
+#url -> WebResponse, with a ttl per entry and lru eviction once the bodies outgrow max_bytes
+class ResponseCache():
+    def __init__(self, maxBytes=4 * 1024 * 1024):
+        self.max_bytes = maxBytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        expires, response, size = self._entries.pop(key)
+        self.size -= size
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, response, ttl):
+        #bodies are str, so count their utf-8 encoding. len() alone would undercount anything non-ascii
+        size = len(key.encode('utf-8')) + len((response.body or '').encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and self.size + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + ttl, response, size)
+        self.size += size
+
+
+class _QueuedRequest():
+    def __init__(self, url, timeout, future):
+        self.url = url
+        self.host = urllib.parse.urlsplit(url).netloc
+        self.timeout = timeout
+        self.future = future
+
+
 class WebWrapper():
-    def __init__(self, loop):
-        self.session = aiohttp.ClientSession(loop=loop)
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    def __init__(self, loop, maxInFlight=16, maxPerHost=4, maxCacheBytes=4 * 1024 * 1024):
+        self.loop = loop
+        #one pooled connector for everything, so repeat calls to the same api reuse a kept-alive connection
+        self.connector = aiohttp.TCPConnector(loop=loop, limit=maxInFlight, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(loop=loop, connector=self.connector)
+        #shared by every RestWrapper that opts into caching
+        self.cache = ResponseCache(maxCacheBytes)
         self.crawlServer = 'http://crawl.akrasiac.org'
-        self.requests = []
+        self.max_in_flight = maxInFlight
+        self.max_per_host = maxPerHost
+        #caller -> that caller's waiting requests, kept sorted by (priority, arrival)
+        self.requests = {}
+        #round robin order of callers with something waiting. whoever was served last goes to the back
+        self._callers = collections.deque()
+        self._sequence = itertools.count()
+        self.in_flight = 0
+        self._host_in_flight = collections.Counter()
+        #url -> future for the request already on its way, so identical requests can share it
+        self._shared = {}
+        self.coalesced = 0
 
     def disconnect(self):
         if self.session and not self.session.closed:
             self.session.close()
 
+    def __len__(self):
+        #requests waiting for a slot
+        return sum(len(q) for q in self.requests.values())
 
-    async def run(self):
-        _logger.info("Starting Web Wrapper")
-        while True:
-            if len(self.requests) != 0:
-                req = self.requests.pop(0)
-                await req
+    def _dispatch(self):
+        #start as many waiting requests as the global and per host caps allow
+        while self.in_flight < self.max_in_flight:
+            picked = None
+            abandoned = False
+            for caller in self._callers:
+                for entry in self.requests[caller]:
+                    if entry[2].future.done():
+                        #the caller gave up while it was waiting. skip it, it gets cleaned up below
+                        abandoned = True
+                        continue
+                    if self._host_in_flight[entry[2].host] < self.max_per_host:
+                        #the most urgent priority wins, and ties go to whoever has waited longest for a turn
+                        if picked is None or entry[0] < picked[1][0]:
+                            picked = (caller, entry)
+                        break
+            if abandoned:
+                self._drop_abandoned()
+            if picked is None:
+                return
+            caller, entry = picked
+            self.requests[caller].remove(entry)
+            self._callers.remove(caller)
+            if self.requests[caller]:
+                self._callers.append(caller)
+            else:
+                del self.requests[caller]
+            #count it now rather than when the task starts, so the caps hold within this loop
+            self.in_flight += 1
+            self._host_in_flight[entry[2].host] += 1
+            asyncio.ensure_future(self._execute(entry[2]))
 
-            #let other async tasks run
-            await asyncio.sleep(5)
+    def _drop_abandoned(self):
+        for caller in list(self._callers):
+            self.requests[caller] = [e for e in self.requests[caller] if not e[2].future.done()]
+            if not self.requests[caller]:
+                del self.requests[caller]
+                self._callers.remove(caller)
 
+    async def _execute(self, request):
+        try:
+            result = await self.fetch(request.url, request.timeout)
+            if not request.future.done():
+                request.future.set_result(result)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self.in_flight -= 1
+            self._host_in_flight[request.host] -= 1
+            if self._host_in_flight[request.host] <= 0:
+                del self._host_in_flight[request.host]
+            self._dispatch()
 
     async def fetch(self, url, timeout):
         _logger.info("http request to [" + url + "] with timeout " + str(timeout))
         with async_timeout.timeout(timeout):
             async with self.session.get(url) as response:
                 _logger.info("got response from [" + url + "] with status: " + str(response.status))
-                await response.text()
-                return response
+                return WebResponse(response.status, await response.text())
 
     async def singleUseSession(self, url, timeout):
         loop = asyncio.get_event_loop()
@@ -45,18 +185,45 @@ class WebWrapper():
         task = loop.create_task(inner())
         return await task
 
-    async def queueRequest(self, url, timeout):
-        coro = self.fetch(url, timeout)
-        self.requests.append(coro)
-        result = await coro
-        return result
+    async def queueRequest(self, url, timeout, priority=PRIORITY_NORMAL, caller='default', coalesce=True):
+        #starts right away if there's capacity, otherwise waits its turn behind higher priorities
+        #and other callers. the timeout only covers the request itself, not the wait.
+        #with coalesce, a request for a url that's already queued or in flight just waits on that one.
+        #only use it for requests that are safe to share (i.e. don't change anything on the other end)
+        if coalesce:
+            shared = self._shared.get(url)
+            if shared is not None:
+                self.coalesced += 1
+                _logger.info("coalesced request to [%s] (%s coalesced so far)", url, self.coalesced)
+                return await asyncio.shield(shared)
+
+        request = _QueuedRequest(url, timeout, self.loop.create_future())
+        queue = self.requests.get(caller)
+        if queue is None:
+            queue = []
+            self.requests[caller] = queue
+            self._callers.append(caller)
+        bisect.insort(queue, (priority, next(self._sequence), request))
+
+        if coalesce:
+            self._shared[url] = request.future
+            def forget(future):
+                if self._shared.get(url) is future:
+                    del self._shared[url]
+            request.future.add_done_callback(forget)
+            self._dispatch()
+            #shielded, so the other waiters still get their answer if this caller gives up
+            return await asyncio.shield(request.future)
+
+        self._dispatch()
+        return await request.future
 
     '''this code might be totally awful. I still don't fully understand async shenanigans'''
     '''ideally this should be a non-blocking http request. I doubt it's actually set up properly to exhibit that behavior right now though'''
     async def doesCrawlUserExist(self, username):
         try:
             _logger.info("checking existence of crawl user: " + username)
-            response = await self.queueRequest(self.crawlServer + '/rawdata/' + username + '/', 5)
+            response = await self.queueRequest(self.crawlServer + '/rawdata/' + username + '/', 5, caller='crawl')
             _logger.info("received response when checking for crawl user: " + username)
             return response.status == 200
         except asyncio.TimeoutError:
@@ -65,12 +232,26 @@ class WebWrapper():
 
 
 class RestWrapper():
-    def __init__(self, webWrapper, baseURL, requiredParameters=None):
+    def __init__(self, webWrapper, baseURL, requiredParameters=None, caller=None, priority=WebWrapper.PRIORITY_NORMAL, cacheTTLs=None, coalesce=True):
         self.web = webWrapper
         self.url = baseURL
         if requiredParameters is None:
             requiredParameters = {}
         self.parameters = requiredParameters
+        #who to charge our requests to when the web wrapper shares out capacity
+        self.caller = caller if caller is not None else urllib.parse.urlsplit(baseURL).netloc
+        self.priority = priority
+        #opt in to caching with a list of (endpoint pattern, seconds). the first fnmatch-style pattern
+        #that matches an endpoint decides how long its successful responses are reused
+        self.cache_ttls = cacheTTLs if cacheTTLs is not None else []
+        #turn this off for apis where identical urls still need to hit the server every time
+        self.coalesce = coalesce
+
+    def _cache_ttl(self, endpoint):
+        for pattern, ttl in self.cache_ttls:
+            if fnmatch.fnmatchcase(endpoint, pattern):
+                return ttl
+        return 0
 
     async def request(self, endpoint, keyList, timeout=25):
         url = self.url + endpoint
@@ -80,24 +261,14 @@ class RestWrapper():
             url += "?"
 
         url += urllib.parse.urlencode(keyList)
-        return await self.web.queueRequest(url, timeout)
 
-class SynchronousRestWrapper():
-    def __init__(self, baseURL, requiredParameters=None):
-        self.url = baseURL
-        if requiredParameters is None:
-            requiredParameters = {}
-        self.parameters = requiredParameters
+        ttl = self._cache_ttl(endpoint)
+        if ttl > 0:
+            cached = self.web.cache.get(url)
+            if cached is not None:
+                return cached
 
-    def request(self, endpoint, keyList, timeout=25):
-        url = self.url + endpoint
-
-        keyList.update(self.parameters)
-        if len(keyList) > 0:
-            url += "?"
-
-        url += urllib.parse.urlencode(keyList)
-        
-        _logger.info("http request to [" + url + "] with timeout " + str(timeout))
-        with urllib.request.urlopen(url) as response:
-            return response.read()
\ No newline at end of file
+        response = await self.web.queueRequest(url, timeout, self.priority, self.caller, self.coalesce)
+        if ttl > 0 and response.status == 200:
+            self.web.cache.put(url, response, ttl)
+        return response